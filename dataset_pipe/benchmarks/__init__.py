@@ -0,0 +1,10 @@
+"""Reproducible CPU benchmarks for the pipeline steps.
+
+Run all cases and append the results to ``benchmarks/results.jsonl``::
+
+    python -m dataset_pipe.benchmarks run
+
+and compare the two most recent commits in the results file::
+
+    python -m dataset_pipe.benchmarks compare
+"""
@@ -0,0 +1,225 @@
+"""Command line interface of the benchmark suite."""
+
+from __future__ import annotations
+
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import platform
+import subprocess
+import sys
+import tempfile
+from typing import Any
+
+RESULTS_FILE = Path("benchmarks/results.jsonl")
+
+
+def _git_commit() -> str:
+    """Return the short commit hash, suffixed with ``-dirty`` for local changes."""
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{commit}-dirty" if dirty else commit
+
+
+def run(args: argparse.Namespace) -> int:
+    from .cases import CASES, measure
+    from .data import SIZES, make_frames, make_video
+
+    cases = args.cases or list(CASES)
+    unknown = [c for c in cases if c not in CASES] + [s for s in args.sizes if s not in SIZES]
+    if unknown:
+        print(f"Unknown cases or sizes: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+
+    commit = _git_commit()
+    env = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+    args.results.parent.mkdir(parents=True, exist_ok=True)
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory(prefix="dsk-bench-") as tmp:
+        root = Path(tmp)
+        for size_name in args.sizes:
+            size = SIZES[size_name]
+            frames = make_frames(root / size_name / "frames", args.frames, size, seed=args.seed)
+            video = make_video(root / size_name / "video.mp4", args.seconds, size)
+            for case in cases:
+                for repeat in range(args.repeat):
+                    scratch = root / size_name / f"{case}-{repeat}"
+                    # A process per run keeps imports and peak RSS independent.
+                    with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                        result = pool.submit(measure, case, frames, video, scratch, args.fps).result()
+                    record = {
+                        "commit": commit,
+                        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                        "case": case,
+                        "size": size_name,
+                        "frames": args.frames,
+                        "seconds_video": args.seconds,
+                        "fps": args.fps,
+                        **result,
+                        **env,
+                    }
+                    with args.results.open("a") as fh:
+                        fh.write(json.dumps(record) + "\n")
+                    print(
+                        f"{case:20s} {size_name:7s} {result['seconds']:8.2f}s "
+                        f"{result['images_per_second']:8.1f} img/s {result['peak_rss_mb']:8.0f} MB",
+                        flush=True,
+                    )
+    return 0
+
+
+def _load(path: Path) -> list[dict[str, Any]]:
+    with path.open() as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+def _best(records: list[dict[str, Any]], commit: str) -> dict[tuple, dict[str, float]]:
+    """Return the fastest run and the lowest peak RSS of every case for ``commit``."""
+
+    best: dict[tuple, dict[str, float]] = {}
+    for rec in records:
+        if rec["commit"] != commit:
+            continue
+        key = (rec["case"], rec["size"], rec["frames"])
+        prev = best.setdefault(key, {"seconds": rec["seconds"], "peak_rss_mb": rec["peak_rss_mb"]})
+        prev["seconds"] = min(prev["seconds"], rec["seconds"])
+        prev["peak_rss_mb"] = min(prev["peak_rss_mb"], rec["peak_rss_mb"])
+    return best
+
+
+def compare(args: argparse.Namespace) -> int:
+    records = _load(args.results)
+    commits: list[str] = []
+    for rec in records:
+        if rec["commit"] not in commits:
+            commits.append(rec["commit"])
+    head = args.head or (commits[-1] if commits else None)
+    base = args.base or next((c for c in reversed(commits) if c != head), None)
+    if head is None or base is None:
+        print("Need results of two commits to compare", file=sys.stderr)
+        return 2
+
+    base_best, head_best = _best(records, base), _best(records, head)
+    regressions = defaultdict(list)
+    print(f"{'case':20s} {'size':7s} {base:>12s} {head:>12s} {'time':>7s} {'rss':>7s}")
+    for key in sorted(base_best.keys() & head_best.keys()):
+        old, new = base_best[key], head_best[key]
+        time_ratio = new["seconds"] / old["seconds"] if old["seconds"] else 1.0
+        rss_ratio = new["peak_rss_mb"] / old["peak_rss_mb"] if old["peak_rss_mb"] else 1.0
+        flag = ""
+        if time_ratio > 1 + args.threshold:
+            regressions[key].append("time")
+        if rss_ratio > 1 + args.threshold:
+            regressions[key].append("rss")
+        if key in regressions:
+            flag = "  REGRESSION (" + ", ".join(regressions[key]) + ")"
+        case, size, _ = key
+        print(
+            f"{case:20s} {size:7s} {old['seconds']:11.2f}s {new['seconds']:11.2f}s "
+            f"{time_ratio:6.2f}x {rss_ratio:6.2f}x{flag}"
+        )
+    return 1 if regressions else 0
+
+
+def imports(args: argparse.Namespace) -> int:
+    from .imports import BUDGETS, check
+
+    commit = _git_commit()
+    failed = False
+    args.results.parent.mkdir(parents=True, exist_ok=True)
+    for module in args.modules or list(BUDGETS):
+        result = check(module, repeat=args.repeat)
+        record = {
+            "commit": commit,
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "case": f"import:{module}",
+            "size": "-",
+            "frames": 0,
+            "seconds": result["seconds"],
+            "peak_rss_mb": 0.0,
+            "heavy": result["heavy"],
+        }
+        with args.results.open("a") as fh:
+            fh.write(json.dumps(record) + "\n")
+        budget = f"{result['budget']:.2f}s" if result["budget"] is not None else "-"
+        status = "ok" if result["ok"] else "OVER BUDGET"
+        if result["heavy"]:
+            status += " (imports " + ", ".join(result["heavy"]) + ")"
+        print(f"{module:45s} {result['seconds']:6.2f}s / {budget:>6s}  {status}", flush=True)
+        failed |= not result["ok"]
+    return 1 if failed else 0
+
+
+def phash(args: argparse.Namespace) -> int:
+    try:
+        from .phash import check
+    except ImportError as e:
+        print(f"Cannot check the perceptual hash: {e}", file=sys.stderr)
+        return 2
+
+    mismatches = check(args.frames, args.seed)
+    for name, expected, actual in mismatches:
+        print(f"{name:30s} imagehash {expected}  phash_batch {actual}")
+    print(f"{len(mismatches)} mismatching hashes", flush=True)
+    return 1 if mismatches else 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the dataset pipeline steps")
+    parser.add_argument("--results", type=Path, default=RESULTS_FILE, help="JSONL file with the results")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run_p = sub.add_parser("run", help="Run the benchmarks and append the results")
+    run_p.add_argument("cases", nargs="*", help="Cases to run (default: all)")
+    run_p.add_argument("--sizes", nargs="+", default=["small", "medium"], help="small, medium and/or large")
+    run_p.add_argument("--frames", type=int, default=64, help="Synthetic frames per size")
+    run_p.add_argument("--seconds", type=int, default=10, help="Length of the synthetic video")
+    run_p.add_argument("--fps", type=int, default=2, help="Extraction rate for the video cases")
+    run_p.add_argument("--repeat", type=int, default=1)
+    run_p.add_argument("--seed", type=int, default=0)
+    run_p.set_defaults(func=run)
+
+    cmp_p = sub.add_parser("compare", help="Compare the results of two commits")
+    cmp_p.add_argument("--base", help="Baseline commit (default: the one before --head)")
+    cmp_p.add_argument("--head", help="Commit to check (default: the latest in the results)")
+    cmp_p.add_argument(
+        "--threshold",
+        type=float,
+        default=0.10,
+        help="Relative slowdown or memory growth reported as a regression",
+    )
+    cmp_p.set_defaults(func=compare)
+
+    imp_p = sub.add_parser("imports", help="Check the import time budget of the entry points")
+    imp_p.add_argument("modules", nargs="*", help="Modules to import (default: all with a budget)")
+    imp_p.add_argument("--repeat", type=int, default=3)
+    imp_p.set_defaults(func=imports)
+
+    phash_p = sub.add_parser("phash", help="Check that the batched pHash matches imagehash.phash")
+    phash_p.add_argument("--frames", type=int, default=16, help="Synthetic frames per size")
+    phash_p.add_argument("--seed", type=int, default=0)
+    phash_p.set_defaults(func=phash)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,129 @@
+"""Benchmark cases: every step on its own and the full pipeline.
+
+Each case receives the prepared inputs and a scratch directory and returns
+the number of images it processed.
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+import resource
+import time
+from typing import Callable
+
+from . import stubs
+
+
+def _count(frames: Path) -> int:
+    return len(list(frames.glob("*.png")))
+
+
+def frame_extraction(frames: Path, video: Path, scratch: Path, fps: int) -> int:
+    from ..pipeline.steps import frame_extraction
+
+    out = frame_extraction.run(video, scratch / "frames", fps=fps)
+    return _count(out)
+
+
+def deduplication(frames: Path, video: Path, scratch: Path, fps: int) -> int:
+    from ..pipeline.steps import deduplication
+
+    deduplication.run(frames, scratch / "dedup")
+    return _count(frames)
+
+
+def filtering(frames: Path, video: Path, scratch: Path, fps: int) -> int:
+    from ..pipeline.steps import filtering
+
+    filtering.run(frames, scratch / "filtering")
+    return _count(frames)
+
+
+def upscaling(frames: Path, video: Path, scratch: Path, fps: int) -> int:
+    from ..pipeline.steps import upscaling
+
+    upscaling.run(frames, scratch / "upscaling", scale=2, model=stubs.StubUpscaler(2))
+    return _count(frames)
+
+
+def cropping(frames: Path, video: Path, scratch: Path, fps: int) -> int:
+    from ..pipeline.steps import cropping
+
+    cropping.run(frames, scratch / "cropping", yolo_model=stubs.YOLO_WEIGHTS, yolo=stubs.StubYolo())
+    return _count(frames)
+
+
+def annotation(frames: Path, video: Path, scratch: Path, fps: int) -> int:
+    from ..pipeline.steps import annotation
+
+    annotation.run(frames, scratch / "captions", trigger_word="bench", preloaded=stubs.stub_tagger())
+    return _count(frames)
+
+
+def classification(frames: Path, video: Path, scratch: Path, fps: int) -> int:
+    from ..pipeline.steps import classification
+
+    classification.run(frames, scratch / "classification", preloaded=stubs.stub_tagger())
+    return _count(frames)
+
+
+def _pipeline(scratch: Path, video: Path, fps: int, **options) -> int:
+    from ..pipeline.pipeline_runner import Pipeline
+
+    stubs.install()
+    pipe = Pipeline(
+        scratch,
+        scratch / "output",
+        scratch / "work",
+        yolo_model=stubs.YOLO_WEIGHTS,
+        preload=True,
+        # Results of earlier repeats must not be reused, whatever the environment says.
+        cache_dir=False,
+        hash_index=False,
+    )
+    pipe.run(video, fps=fps, scale=2, **options)
+    return pipe.metrics.stages["Deduplication"].images
+
+
+def pipeline(frames: Path, video: Path, scratch: Path, fps: int) -> int:
+    return _pipeline(scratch, video, fps)
+
+
+def pipeline_streaming(frames: Path, video: Path, scratch: Path, fps: int) -> int:
+    return _pipeline(scratch, video, fps, streaming=True)
+
+
+def pipeline_pipelined(frames: Path, video: Path, scratch: Path, fps: int) -> int:
+    return _pipeline(scratch, video, fps, pipelined=True)
+
+
+CASES: dict[str, Callable[[Path, Path, Path, int], int]] = {
+    "frame_extraction": frame_extraction,
+    "deduplication": deduplication,
+    "filtering": filtering,
+    "upscaling": upscaling,
+    "cropping": cropping,
+    "annotation": annotation,
+    "classification": classification,
+    "pipeline": pipeline,
+    "pipeline_streaming": pipeline_streaming,
+    "pipeline_pipelined": pipeline_pipelined,
+}
+
+
+def measure(case: str, frames: Path, video: Path, scratch: Path, fps: int) -> dict[str, float]:
+    """Run ``case`` and return its image count, duration and peak RSS.
+
+    Meant to run in a fresh process so the peak RSS belongs to the case.
+    """
+
+    start = time.perf_counter()
+    images = CASES[case](frames, video, scratch, fps)
+    seconds = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "images": images,
+        "seconds": seconds,
+        "images_per_second": images / seconds if seconds else 0.0,
+        "peak_rss_mb": peak_kb / 1024,
+    }
@@ -0,0 +1,89 @@
+"""Synthetic inputs for the benchmarks."""
+
+from __future__ import annotations
+
+from pathlib import Path
+import subprocess
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+# Named input sizes (width, height).
+SIZES = {
+    "small": (320, 180),
+    "medium": (640, 360),
+    "large": (1280, 720),
+}
+
+# Every scene is repeated with small noise so deduplication has work to do.
+_FRAMES_PER_SCENE = 4
+
+
+def _scene(rng: np.random.Generator, size: tuple[int, int]) -> Image.Image:
+    width, height = size
+    ramp = np.linspace(0, 255, width, dtype=np.float32)
+    base = np.empty((height, width, 3), dtype=np.float32)
+    for c in range(3):
+        base[:, :, c] = np.roll(ramp, int(rng.integers(width)))[None, :] * rng.uniform(0.3, 1.0)
+    img = Image.fromarray(base.astype(np.uint8))
+    draw = ImageDraw.Draw(img)
+    for _ in range(int(rng.integers(4, 10))):
+        x, y = int(rng.integers(width)), int(rng.integers(height))
+        r = int(rng.integers(min(size) // 16, min(size) // 4))
+        color = tuple(int(v) for v in rng.integers(0, 256, 3))
+        if rng.random() < 0.5:
+            draw.ellipse((x - r, y - r, x + r, y + r), fill=color)
+        else:
+            draw.rectangle((x - r, y - r, x + r, y + r), fill=color)
+    return img
+
+
+def make_frames(directory: Path, count: int, size: tuple[int, int], *, seed: int = 0) -> Path:
+    """Write ``count`` synthetic PNG frames of ``size`` to ``directory``.
+
+    The frames are deterministic for a given ``seed``. Consecutive frames
+    share a scene and differ only by noise, every 8th scene is very dark and
+    every 11th one blurred so the quality checks reject some of them.
+    """
+
+    directory.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    scene = None
+    for idx in range(count):
+        scene_idx, offset = divmod(idx, _FRAMES_PER_SCENE)
+        if offset == 0:
+            scene = _scene(rng, size)
+            if scene_idx % 8 == 7:
+                scene = scene.point(lambda v: v // 10)
+            elif scene_idx % 11 == 10:
+                scene = scene.filter(ImageFilter.GaussianBlur(8))
+        arr = np.asarray(scene, dtype=np.int16)
+        arr = arr + rng.integers(-3, 4, arr.shape, dtype=np.int16)
+        frame = Image.fromarray(np.clip(arr, 0, 255).astype(np.uint8))
+        frame.save(directory / f"frame_{idx + 1:04d}.png")
+    return directory
+
+
+def make_video(path: Path, seconds: int, size: tuple[int, int], *, rate: int = 25) -> Path:
+    """Render a ``seconds`` long ffmpeg ``testsrc`` video of ``size`` to ``path``."""
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    width, height = size
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-y",
+            "-f",
+            "lavfi",
+            "-i",
+            f"testsrc=duration={seconds}:size={width}x{height}:rate={rate}",
+            "-pix_fmt",
+            "yuv420p",
+            str(path),
+        ],
+        check=True,
+    )
+    return path
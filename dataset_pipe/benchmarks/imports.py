@@ -0,0 +1,63 @@
+"""Import time budget of the pipeline entry points."""
+
+from __future__ import annotations
+
+import json
+import subprocess
+import sys
+
+# Dependencies that must only be imported by the stage that uses them.
+HEAVY_MODULES = (
+    "torch",
+    "torchvision",
+    "ultralytics",
+    "open_clip",
+    "umap",
+    "sklearn",
+    "mediapipe",
+    "onnxruntime",
+    "huggingface_hub",
+    "realesrgan",
+    "animeface",
+    "cv2",
+)
+
+# Module -> import time budget in seconds.
+BUDGETS = {
+    "dataset_pipe.pipeline.run_pipeline": 0.3,
+    "dataset_pipe.pipeline.pipeline_runner": 0.8,
+    "dataset_pipe.pipeline.service": 0.3,
+    "dataset_pipe.pipeline.steps.deduplication": 1.0,
+}
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+heavy = sorted(m for m in {heavy!r} if m in sys.modules)
+print(json.dumps({{"seconds": seconds, "heavy": heavy}}))
+"""
+
+
+def measure_import(module: str) -> dict[str, object]:
+    """Import ``module`` in a fresh interpreter and return its time and heavy imports."""
+
+    code = _PROBE.format(module=module, heavy=HEAVY_MODULES)
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def check(module: str, repeat: int = 3) -> dict[str, object]:
+    """Return the fastest of ``repeat`` imports of ``module`` and whether it fits the budget."""
+
+    runs = [measure_import(module) for _ in range(repeat)]
+    best = min(runs, key=lambda r: r["seconds"])
+    budget = BUDGETS.get(module)
+    return {
+        "module": module,
+        "seconds": best["seconds"],
+        "budget": budget,
+        "heavy": best["heavy"],
+        "ok": not best["heavy"] and (budget is None or best["seconds"] <= budget),
+    }
@@ -0,0 +1,43 @@
+"""Regression check of the batched perceptual hash against ``imagehash``."""
+
+from __future__ import annotations
+
+from pathlib import Path
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from .data import SIZES, make_frames
+
+# Sizes beyond the benchmark ones: square, portrait and a tiny odd size.
+EXTRA_SIZES = [(256, 256), (180, 320), (33, 17)]
+
+
+def check(count: int = 16, seed: int = 0) -> list[tuple[str, str, str]]:
+    """Return the ``(image, expected, actual)`` of every hash that differs.
+
+    ``count`` synthetic frames of every size are hashed one by one with
+    ``imagehash.phash`` and in a single batch with ``phash_batch``.
+    """
+
+    import imagehash
+
+    from ..pipeline.steps.deduplication import _phash_pixels, phash_batch
+
+    mismatches = []
+    with tempfile.TemporaryDirectory(prefix="dsk-phash-") as tmp:
+        for width, height in list(SIZES.values()) + EXTRA_SIZES:
+            frames = make_frames(Path(tmp) / f"{width}x{height}", count, (width, height), seed=seed)
+            paths = sorted(frames.glob("*.png"))
+            pixels = []
+            expected = []
+            for path in paths:
+                with Image.open(path) as img:
+                    pixels.append(_phash_pixels(img))
+                    expected.append(str(imagehash.phash(img)))
+            actual = phash_batch(np.stack(pixels))
+            for path, want, got in zip(paths, expected, actual):
+                if want != got:
+                    mismatches.append((f"{width}x{height}/{path.name}", want, got))
+    return mismatches
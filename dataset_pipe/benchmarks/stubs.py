@@ -0,0 +1,117 @@
+"""Stand-in models for benchmarking without downloading weights.
+
+The stubs mimic the interfaces the steps use and do a comparable amount of
+array work, so the numbers reflect the pipeline's own overhead (decoding,
+preprocessing, I/O) rather than the real networks.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+import cv2
+import numpy as np
+
+from ..pipeline.steps.classification import EYE_COLORS, HAIR_COLORS, HAIR_LENGTHS
+
+YOLO_WEIGHTS = Path("stub-yolo.pt")
+
+_GENERIC_TAGS = ["1girl", "solo", "smile", "looking_at_viewer", "outdoors", "sky", "upper_body", "open_mouth"]
+# WD14 outputs the general, sensitive, questionable and explicit ratings first.
+_RATINGS = 4
+
+
+class StubUpscaler:
+    """Bicubic resize behind the ``RealESRGANer.enhance`` interface."""
+
+    def __init__(self, scale: int) -> None:
+        self.scale = scale
+
+    def enhance(self, img: np.ndarray) -> tuple[np.ndarray, None]:
+        height, width = img.shape[:2]
+        size = (width * self.scale, height * self.scale)
+        return cv2.resize(img, size, interpolation=cv2.INTER_CUBIC), None
+
+
+@dataclass
+class _Box:
+    xyxy: list[np.ndarray]
+    conf: list[float]
+
+
+@dataclass
+class _Result:
+    boxes: list[_Box]
+
+
+class StubYolo:
+    """Returns one centred face box per image, like an ultralytics ``YOLO``."""
+
+    ckpt_path = str(YOLO_WEIGHTS)
+
+    def __call__(self, imgs: list[Any]) -> list[_Result]:
+        results = []
+        for img in imgs:
+            arr = np.asarray(img, dtype=np.float32)
+            width, height = img.size
+            conf = 0.5 + float(arr.mean()) / 512
+            box = np.array([width / 4, height / 4, width * 3 / 4, height * 3 / 4])
+            results.append(_Result([_Box([box], [conf])]))
+        return results
+
+
+@dataclass
+class _Node:
+    name: str
+    shape: list[Any]
+
+
+class StubTaggerSession:
+    """Derives deterministic tag scores from the input tensor.
+
+    Every image gets one hair and one eye colour above the classification
+    thresholds so classification never needs CLIP clustering. Like WD14 the
+    output starts with the four rating scores, tag ``i`` is at ``i + 4``.
+    """
+
+    def __init__(self, tags: list[str], image_size: int) -> None:
+        self.tags = tags
+        self.image_size = image_size
+
+    def get_inputs(self) -> list[_Node]:
+        return [_Node("input", [1, self.image_size, self.image_size, 3])]
+
+    def get_outputs(self) -> list[_Node]:
+        return [_Node("output", [1, _RATINGS + len(self.tags)])]
+
+    def run(self, output_names: list[str], feeds: dict[str, np.ndarray]) -> list[np.ndarray]:
+        tensor = feeds["input"]
+        channels = tensor.mean(axis=(0, 1, 2))
+        scores = np.full(_RATINGS + len(self.tags), 0.05, dtype=np.float32)
+        scores[:_RATINGS] = (0.9, 0.05, 0.03, 0.02)
+        scores[_RATINGS : _RATINGS + len(_GENERIC_TAGS)] = np.linspace(0.9, 0.4, len(_GENERIC_TAGS))
+        offset = _RATINGS + len(_GENERIC_TAGS)
+        for group, value in ((HAIR_COLORS, channels[0]), (EYE_COLORS, channels[1]), (HAIR_LENGTHS, channels[2])):
+            scores[offset + int(value) % len(group)] = 0.8
+            offset += len(group)
+        return [scores[None, :]]
+
+
+def stub_tagger(image_size: int = 448) -> tuple[StubTaggerSession, int, list[str]]:
+    """Return a stub with the ``(session, image_size, tags)`` shape of ``_load_tagger``."""
+
+    tags = _GENERIC_TAGS + HAIR_COLORS + EYE_COLORS + HAIR_LENGTHS
+    return StubTaggerSession(tags, image_size), image_size, tags
+
+
+def install() -> None:
+    """Replace the loaders of the shared model registry with the stubs."""
+
+    from ..pipeline.preloader import registry
+
+    registry.clear()
+    registry.register("realesrgan", lambda device, scale, backend=None, threads=None: StubUpscaler(scale))
+    registry.register("yolo", lambda model_path: StubYolo())
+    registry.register("tagger", lambda device: stub_tagger())
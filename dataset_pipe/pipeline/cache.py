@@ -0,0 +1,158 @@
+"""Persistent content addressed cache for expensive per-image results."""
+
+from __future__ import annotations
+
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+from PIL import Image
+
+from .logging_utils import log_step
+
+DEFAULT_MAX_GB = 20.0
+
+
+def image_digest(img: Image.Image) -> str:
+    """Return a hash of the decoded pixels of ``img``.
+
+    Hashing pixels instead of files makes cache keys independent of how an
+    image was encoded, so the directory and streaming modes share entries.
+    """
+
+    digest = hashlib.sha256()
+    digest.update(f"{img.mode}:{img.width}x{img.height}:".encode())
+    digest.update(img.tobytes())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """On-disk cache keyed by image content, stage, model and parameters.
+
+    Entries are stored as individual files below ``root``. Every hit updates
+    the file's modification time and :meth:`trim` removes the least recently
+    used entries once the cache grows beyond ``max_bytes``.
+    """
+
+    def __init__(self, root: Path, max_bytes: int) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        root.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def from_env(cls, root: Path | None = None) -> "ResultCache | None":
+        """Create the cache configured by ``DSK_CACHE_DIR``/``DSK_CACHE_MAX_GB``.
+
+        Returns ``None`` when no cache directory is configured.
+        """
+
+        if root is None:
+            env_root = os.getenv("DSK_CACHE_DIR")
+            if not env_root:
+                return None
+            root = Path(env_root)
+        max_gb = float(os.getenv("DSK_CACHE_MAX_GB", DEFAULT_MAX_GB))
+        return cls(root, int(max_gb * 1024**3))
+
+    @staticmethod
+    def key(digest: str, stage: str, model: str, **params: Any) -> str:
+        """Return the cache key for a result of ``stage`` on the image ``digest``."""
+
+        payload = json.dumps(
+            {"digest": digest, "stage": stage, "model": model, "params": params},
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def get(self, key: str) -> bytes | None:
+        """Return the stored bytes for ``key`` or ``None`` on a miss."""
+
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        os.utime(path)
+        self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        """Store ``data`` under ``key``."""
+
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+    def get_image(self, key: str) -> Image.Image | None:
+        data = self.get(key)
+        if data is None:
+            return None
+        with Image.open(io.BytesIO(data)) as img:
+            return img.convert("RGB")
+
+    def put_image(self, key: str, img: Image.Image) -> None:
+        buf = io.BytesIO()
+        img.save(buf, format="PNG")
+        self.put(key, buf.getvalue())
+
+    def get_array(self, key: str) -> np.ndarray | None:
+        data = self.get(key)
+        if data is None:
+            return None
+        return np.load(io.BytesIO(data), allow_pickle=False)
+
+    def put_array(self, key: str, arr: np.ndarray) -> None:
+        buf = io.BytesIO()
+        np.save(buf, arr, allow_pickle=False)
+        self.put(key, buf.getvalue())
+
+    def get_json(self, key: str) -> Any:
+        data = self.get(key)
+        if data is None:
+            return None
+        return json.loads(data)
+
+    def put_json(self, key: str, value: Any) -> None:
+        self.put(key, json.dumps(value).encode())
+
+    def trim(self) -> None:
+        """Evict least recently used entries until the cache fits ``max_bytes``."""
+
+        entries = []
+        total = 0
+        for path in self.root.glob("*/*"):
+            if path.suffix == ".tmp":
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # removed by a concurrent job
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:  # a concurrent trim was faster
+                continue
+            total -= size
+            removed += 1
+        log_step(f"Cache trimmed: removed {removed} entries")
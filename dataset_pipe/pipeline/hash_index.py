@@ -0,0 +1,127 @@
+"""Persistent index of the perceptual hashes kept by earlier jobs."""
+
+from __future__ import annotations
+
+import fcntl
+import json
+import os
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+# Hashes are stored as raw little endian 64 bit integers, 8 bytes each.
+_DTYPE = np.dtype("<u8")
+
+
+class PersistentHashIndex:
+    """Append-only file of 64 bit perceptual hashes shared across jobs.
+
+    Opening the index memory-maps the file, so it costs the same for ten or
+    ten million hashes. New hashes are appended with a single write while
+    holding an exclusive lock, which keeps concurrent jobs from interleaving.
+    ``<path>.sources`` records which rows every source (video or image
+    directory) added, so running a job on the same source again does not
+    drop its own frames.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.sources_path = path.with_name(path.name + ".sources")
+
+    @classmethod
+    def from_env(cls, path: Path | None = None) -> "PersistentHashIndex | None":
+        """Create the index configured by ``DSK_HASH_INDEX``.
+
+        Returns ``None`` when no index file is configured.
+        """
+
+        if path is None:
+            env_path = os.getenv("DSK_HASH_INDEX")
+            if not env_path:
+                return None
+            path = Path(env_path)
+        return cls(path)
+
+    def _ranges(self, source: str) -> list[tuple[int, int]]:
+        """Return the ``(start, count)`` rows appended for ``source``."""
+
+        try:
+            lines = self.sources_path.read_text().splitlines()
+        except FileNotFoundError:
+            return []
+        ranges = []
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:  # last line may be truncated by a crash
+                continue
+            if entry.get("source") == source:
+                ranges.append((entry["start"], entry["count"]))
+        return ranges
+
+    def load(self, exclude: str | None = None) -> np.ndarray:
+        """Return the stored hashes as a read-only ``uint64`` array.
+
+        Hashes added for the source ``exclude`` are left out; the result is
+        then a copy instead of a memory map.
+        """
+
+        try:
+            size = self.path.stat().st_size
+        except FileNotFoundError:
+            return np.empty(0, dtype=np.uint64)
+        # A partial record left by an interrupted write is ignored.
+        count = size // _DTYPE.itemsize
+        if not count:
+            return np.empty(0, dtype=np.uint64)
+        hashes = np.memmap(self.path, dtype=_DTYPE, mode="r", shape=(count,))
+        ranges = self._ranges(exclude) if exclude is not None else []
+        if not ranges:
+            return hashes
+        keep = np.ones(count, dtype=bool)
+        for start, length in ranges:
+            keep[start:start + length] = False
+        return np.asarray(hashes[keep])
+
+    def append(self, hashes: Iterable[str], source: str | None = None) -> int:
+        """Append the hex ``hashes`` and return how many were written.
+
+        With ``source``, hashes already added for the same source are skipped
+        and the appended rows are recorded for :meth:`load`.
+        """
+
+        data = np.array([int(h, 16) for h in hashes], dtype=_DTYPE)
+        if not len(data):
+            return 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open("ab") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                # Drop a partial record so the file stays aligned.
+                end = fh.seek(0, os.SEEK_END)
+                if end % _DTYPE.itemsize:
+                    end -= end % _DTYPE.itemsize
+                    fh.truncate(end)
+                if source is not None:
+                    own = self._ranges(source)
+                    if own:
+                        known = np.concatenate([
+                            np.fromfile(self.path, dtype=_DTYPE, count=length, offset=start * _DTYPE.itemsize)
+                            for start, length in own
+                        ])
+                        data = data[~np.isin(data, known)]
+                    if not len(data):
+                        return 0
+                fh.write(data.tobytes())
+                fh.flush()
+                os.fsync(fh.fileno())
+                if source is not None:
+                    entry = {"source": source, "start": end // _DTYPE.itemsize, "count": len(data)}
+                    with self.sources_path.open("a") as sources:
+                        sources.write(json.dumps(entry) + "\n")
+                        sources.flush()
+                        os.fsync(sources.fileno())
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+        return len(data)
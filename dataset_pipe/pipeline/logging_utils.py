@@ -2,6 +2,7 @@ import logging
 import os
 from pathlib import Path
 from datetime import datetime
+from typing import Callable
 
 LOG_FILE = Path("logs/process.log")
 
@@ -37,18 +38,52 @@ logger.propagate = False
 
 PROGRESS_ENV = os.getenv("PROGRESS")
 
+# Additional receivers of the progress output, e.g. a service client.
+_sinks: list[Callable[[str], None]] = []
+
+
+def add_sink(sink: Callable[[str], None]) -> None:
+    """Send every line that is printed in ``PROGRESS`` mode to ``sink`` as well."""
+    _sinks.append(sink)
+
+
+def remove_sink(sink: Callable[[str], None]) -> None:
+    if sink in _sinks:
+        _sinks.remove(sink)
+
+
+# Callbacks receiving every ``log_progress`` call, e.g. for metrics.
+_progress_hooks: list[Callable[[str, int, int], None]] = []
+
+
+def add_progress_hook(hook: Callable[[str, int, int], None]) -> None:
+    """Call ``hook(prefix, count, total)`` on every :func:`log_progress`."""
+    _progress_hooks.append(hook)
+
+
+def remove_progress_hook(hook: Callable[[str, int, int], None]) -> None:
+    if hook in _progress_hooks:
+        _progress_hooks.remove(hook)
+
+
+def _emit(line: str) -> None:
+    if PROGRESS_ENV:
+        print(line, flush=True)
+    for sink in list(_sinks):
+        sink(line)
+
 
 def log_step(step: str) -> None:
     logger.dsk(step)
-    if PROGRESS_ENV:
-        print(step, flush=True)
+    _emit(step)
 
 
 def log_progress(prefix: str, count: int, total: int) -> None:
     """Log a progress message of the form ``'<prefix> count/total'``."""
     logger.dsk(f"{prefix} {count}/{total}")
-    if PROGRESS_ENV:
-        print(f"PROGRESS {count} {total}", flush=True)
+    for hook in list(_progress_hooks):
+        hook(prefix, count, total)
+    _emit(f"PROGRESS {count} {total}")
 
 
 def rotate_log(job_name: str) -> None:
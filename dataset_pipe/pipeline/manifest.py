@@ -0,0 +1,141 @@
+"""Per-stage manifests used to resume interrupted pipeline runs."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+from pathlib import Path
+from typing import Any
+
+from .logging_utils import log_step
+
+
+def file_hash(path: Path) -> str:
+    """Return the SHA-256 hex digest of the file at ``path``."""
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_digest(path: Path, *, exact: bool = True) -> str:
+    """Return a digest identifying the input video or image directory ``path``.
+
+    Only names, sizes and modification times are hashed, so this is cheap
+    even for large videos but still changes when another input is used.
+    With ``exact=False`` the location of ``path`` and the modification times
+    are left out, so a copy of the same input has the same digest.
+    """
+
+    if not path.exists():
+        raise FileNotFoundError(f"input {path} does not exist")
+    digest = hashlib.sha256()
+    files = sorted(p for p in path.rglob("*") if p.is_file()) if path.is_dir() else [path]
+    for file in files:
+        stat = file.stat()
+        if path.is_dir():
+            name = file.relative_to(path)
+        else:
+            name = file if exact else file.name
+        mtime = stat.st_mtime_ns if exact else 0
+        digest.update(f"{name}\0{stat.st_size}\0{mtime}\n".encode())
+    return digest.hexdigest()
+
+
+class StageManifest:
+    """Append-only record of the inputs a stage has processed.
+
+    The first line of the file stores the stage parameters. Every following
+    line describes one processed input by name, content hash and the outputs
+    it produced, and a final ``{"completed": true}`` line marks the stage as
+    finished. When ``resume`` is set and the stored parameters match, the
+    existing entries are loaded so the stage can skip finished inputs;
+    otherwise the manifest starts from scratch.
+    """
+
+    def __init__(self, path: Path, params: dict[str, Any], *, resume: bool = False) -> None:
+        self.path = path
+        self.params = json.loads(json.dumps(params, default=str))
+        self.entries: dict[str, dict[str, Any]] = {}
+        self.completed = False
+        self.resumed = False
+
+        if resume and path.exists():
+            self._load()
+        if not self.resumed:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, "w", encoding="utf-8") as fh:
+                fh.write(json.dumps({"params": self.params}) + "\n")
+
+    def _load(self) -> None:
+        with open(self.path, encoding="utf-8") as fh:
+            lines = fh.read().splitlines()
+        if not lines:
+            return
+        try:
+            header = json.loads(lines[0])
+        except ValueError:
+            return
+        if header.get("params") != self.params:
+            log_step(f"Parameters changed for {self.path.stem}; starting stage from scratch")
+            return
+        self.resumed = True
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:  # last line may be truncated by a crash
+                continue
+            if entry.get("completed"):
+                self.completed = True
+            elif "input" in entry:
+                self.entries[entry["input"]] = entry
+
+    def _append(self, entry: dict[str, Any]) -> None:
+        with open(self.path, "a", encoding="utf-8") as fh:
+            fh.write(json.dumps(entry) + "\n")
+
+    def entry(self, src: Path) -> dict[str, Any] | None:
+        """Return the stored entry for ``src`` if it is still valid."""
+
+        entry = self.entries.get(src.name)
+        if entry is None:
+            return None
+        if not all(Path(out).exists() for out in entry["outputs"]):
+            return None
+        if entry["sha256"] != file_hash(src):
+            return None
+        return entry
+
+    def done(self, src: Path) -> bool:
+        """Return ``True`` if ``src`` was already processed with the same content."""
+
+        return self.entry(src) is not None
+
+    def record(self, src: Path, outputs: list[Path], **extra: Any) -> None:
+        """Store that ``src`` was processed into ``outputs``."""
+
+        entry = {
+            "input": src.name,
+            "sha256": file_hash(src),
+            "outputs": [str(out) for out in outputs],
+            **extra,
+        }
+        self.entries[src.name] = entry
+        self._append(entry)
+
+    def digest(self) -> str:
+        """Return a digest of the stored parameters and processed inputs.
+
+        Later stages include it in their parameters, so they are only resumed
+        when this stage processed the same inputs in the same way.
+        """
+
+        return file_hash(self.path)
+
+    def complete(self) -> None:
+        """Mark the stage as finished."""
+
+        self.completed = True
+        self._append({"completed": True})
@@ -0,0 +1,286 @@
+"""Per-stage timing, throughput and resource metrics for pipeline runs."""
+
+from __future__ import annotations
+
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+import json
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Any, Iterable, Iterator, TypeVar
+
+from .logging_utils import add_progress_hook, remove_progress_hook
+
+T = TypeVar("T")
+
+_SAMPLE_INTERVAL = 0.05
+
+
+def rss_bytes() -> int:
+    """Return the resident set size of this process."""
+
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):  # pragma: no cover - non Linux
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def dir_bytes(path: Path | None) -> int:
+    """Return the total size of all files below ``path``."""
+
+    if path is None or not path.exists():
+        return 0
+    return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+
+
+@dataclass
+class StageMetrics:
+    wall_seconds: float = 0.0
+    inference_seconds: float = 0.0
+    images: int = 0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    peak_rss_bytes: int = 0
+    image_seconds: list[float] = field(default_factory=list)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "wall_seconds": self.wall_seconds,
+            "inference_seconds": self.inference_seconds,
+            "io_seconds": max(0.0, self.wall_seconds - self.inference_seconds),
+            "images": self.images,
+            "images_per_second": self.images / self.wall_seconds if self.wall_seconds else 0.0,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "peak_rss_bytes": self.peak_rss_bytes,
+            "image_seconds": self.image_seconds,
+        }
+
+
+class Metrics:
+    """Collects metrics for the stages of one pipeline run.
+
+    Stage wall time is measured by :meth:`stage` (directory mode) or
+    :meth:`track` (streaming mode). Every ``log_progress`` call counts as one
+    processed image and the time since the previous call of the same stage
+    becomes its per-image time. Steps report model time via
+    :func:`inference`; everything else in a stage counts as I/O time. A
+    background thread samples the RSS to find each stage's peak.
+    """
+
+    def __init__(self) -> None:
+        self.stages: dict[str, StageMetrics] = {}
+        self.models: dict[str, dict[str, float]] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._active: set[str] = set()
+        self._last_progress: dict[str, float] = {}
+        self._stop = threading.Event()
+        self._sampler: threading.Thread | None = None
+        self.started = time.perf_counter()
+        self.finished: float | None = None
+
+    def _get(self, name: str) -> StageMetrics:
+        with self._lock:
+            return self.stages.setdefault(name, StageMetrics())
+
+    def _stack(self) -> list[list]:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def current_stage(self) -> str | None:
+        """Return the stage the calling thread is working on."""
+
+        stack = self._stack()
+        return stack[-1][0] if stack else None
+
+    def _activate(self, name: str) -> None:
+        with self._lock:
+            self._active.add(name)
+            self._last_progress.setdefault(name, time.perf_counter())
+        self._sample()
+
+    def _deactivate(self, name: str) -> None:
+        self._sample()
+        with self._lock:
+            self._active.discard(name)
+
+    def _sample(self) -> None:
+        rss = rss_bytes()
+        with self._lock:
+            for name in self._active:
+                stage = self.stages.setdefault(name, StageMetrics())
+                stage.peak_rss_bytes = max(stage.peak_rss_bytes, rss)
+
+    def _sample_loop(self) -> None:
+        while not self._stop.wait(_SAMPLE_INTERVAL):
+            self._sample()
+
+    def start(self) -> None:
+        """Start sampling and make this the collector used by :func:`inference`."""
+
+        global _collector
+        _collector = self
+        add_progress_hook(self._on_progress)
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample_loop, daemon=True)
+        self._sampler.start()
+
+    def stop(self) -> None:
+        global _collector
+        if _collector is self:
+            _collector = None
+        remove_progress_hook(self._on_progress)
+        self._stop.set()
+        if self.finished is None:
+            self.finished = time.perf_counter()
+        if self._sampler is not None:
+            self._sampler.join()
+            self._sampler = None
+
+    def _on_progress(self, prefix: str, count: int, total: int) -> None:
+        now = time.perf_counter()
+        with self._lock:
+            stage = self.stages.setdefault(prefix, StageMetrics())
+            last = self._last_progress.get(prefix)
+            if last is not None:
+                stage.image_seconds.append(now - last)
+            self._last_progress[prefix] = now
+            stage.images += 1
+
+    @contextmanager
+    def stage(self, name: str, input_dir: Path | None = None, output_dir: Path | None = None) -> Iterator[None]:
+        """Measure a directory based stage reading ``input_dir`` and writing ``output_dir``."""
+
+        stage = self._get(name)
+        stage.bytes_read += dir_bytes(input_dir)
+        self._activate(name)
+        stack = self._stack()
+        stack.append([name, 0.0])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage.wall_seconds += time.perf_counter() - start
+            stack.pop()
+            self._deactivate(name)
+            stage.bytes_written += dir_bytes(output_dir)
+
+    def track(
+        self,
+        name: str,
+        records: Iterable[T],
+        input_dir: Path | None = None,
+        output_dir: Path | None = None,
+    ) -> Iterator[T]:
+        """Measure the time spent inside a streaming stage generator.
+
+        Only the time of the stage itself is counted, time spent in upstream
+        generators is subtracted. In pipelined mode this includes the time a
+        stage waits for its input queue.
+        """
+
+        it = iter(records)
+        stage = self._get(name)
+        stage.bytes_read += dir_bytes(input_dir)
+        self._activate(name)
+        count = 0
+        try:
+            while True:
+                stack = self._stack()
+                frame = [name, 0.0]
+                stack.append(frame)
+                start = time.perf_counter()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed = time.perf_counter() - start
+                    stack.pop()
+                    if stack:
+                        stack[-1][1] += elapsed
+                    stage.wall_seconds += elapsed - frame[1]
+                count += 1
+                yield item
+        finally:
+            self._deactivate(name)
+            stage.bytes_written += dir_bytes(output_dir)
+            # Stages without progress output (decoding, writing) count their items.
+            with self._lock:
+                if not stage.images:
+                    stage.images = count
+
+    def add_inference(self, name: str, seconds: float) -> None:
+        stage = self._get(name)
+        with self._lock:
+            stage.inference_seconds += seconds
+
+    def report(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "total_seconds": (self.finished or time.perf_counter()) - self.started,
+                "peak_rss_bytes": max((s.peak_rss_bytes for s in self.stages.values()), default=0),
+                "stages": {name: stage.to_dict() for name, stage in self.stages.items()},
+                "models": dict(self.models),
+            }
+
+    def write_json(self, path: Path) -> None:
+        path.write_text(json.dumps(self.report(), indent=2))
+
+    def to_prometheus(self) -> str:
+        """Return the stage and model metrics in the Prometheus text format."""
+
+        report = self.report()
+        lines: list[str] = []
+
+        def _family(metric: str, help_text: str, samples: list[tuple[str, float]]) -> None:
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            for labels, value in samples:
+                lines.append(f"{metric}{{{labels}}} {value}")
+
+        stage_fields = [
+            ("wall_seconds", "Wall time spent in the stage"),
+            ("inference_seconds", "Time spent in model inference"),
+            ("io_seconds", "Time spent outside model inference"),
+            ("images", "Images processed by the stage"),
+            ("images_per_second", "Stage throughput"),
+            ("bytes_read", "Bytes read from the stage input directory"),
+            ("bytes_written", "Bytes written to the stage output directory"),
+            ("peak_rss_bytes", "Peak resident set size while the stage ran"),
+        ]
+        for key, help_text in stage_fields:
+            samples = [(f'stage="{name}"', stage[key]) for name, stage in report["stages"].items()]
+            _family(f"dsk_stage_{key}", help_text, samples)
+        for key, help_text in [("load_seconds", "Model load time"), ("size_bytes", "Model resident size")]:
+            samples = [(f'model="{name}"', model[key]) for name, model in report["models"].items()]
+            _family(f"dsk_model_{key}", help_text, samples)
+        _family("dsk_run_seconds", "Total run time", [("", report["total_seconds"])])
+        return "\n".join(lines) + "\n"
+
+
+_collector: Metrics | None = None
+
+
+@contextmanager
+def inference() -> Iterator[None]:
+    """Count the enclosed block as model inference time of the current stage."""
+
+    metrics = _collector
+    stage = metrics.current_stage() if metrics is not None else None
+    if stage is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_inference(stage, time.perf_counter() - start)
@@ -0,0 +1,61 @@
+"""Process pool execution shared by the CPU bound pipeline steps."""
+
+from __future__ import annotations
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+import multiprocessing
+import os
+from typing import Any, Callable, Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def default_workers() -> int:
+    """Return the worker count configured via ``DSK_WORKERS`` (default ``1``)."""
+
+    return max(1, int(os.getenv("DSK_WORKERS", "1")))
+
+
+def imap(
+    fn: Callable[[T], R],
+    items: Iterable[T],
+    *,
+    workers: int = 1,
+    initializer: Callable[..., Any] | None = None,
+    initargs: tuple = (),
+    prefetch: int = 4,
+) -> Iterator[R]:
+    """Apply ``fn`` to every item and yield the results in input order.
+
+    With ``workers > 1`` the calls run in a pool of ``spawn``-ed processes,
+    each set up once by ``initializer`` (e.g. to create a detector). At most
+    ``workers * prefetch`` items are in flight so memory stays bounded. With a
+    single worker everything runs inline after calling ``initializer`` in the
+    current process. ``fn`` and its arguments must be picklable.
+    """
+
+    if workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for item in items:
+            yield fn(item)
+        return
+
+    pool = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=initializer,
+        initargs=initargs,
+    )
+    pending: deque[Future[R]] = deque()
+    try:
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            if len(pending) >= workers * prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
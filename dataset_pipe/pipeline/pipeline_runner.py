@@ -1,28 +1,40 @@
+import json
 from pathlib import Path
 import os
+import re
 import shutil
 import zipfile
-from typing import Callable
-import torch
+from typing import TYPE_CHECKING, Any, Callable
 
+from .cache import ResultCache
+from .hash_index import PersistentHashIndex
 from .logging_utils import log_step
-from .steps import (
-    frame_extraction,
-    deduplication,
-    classification,
-    filtering,
-    upscaling,
-    cropping,
-    annotation,
-)
+from .manifest import StageManifest, source_digest
+from .metrics import Metrics
+from .parallel import default_workers
+from .tag_scores import TagScoreStore
+from .records import background, count_images, drain, load_records, save_records
+from .transfer import link_tree
+from . import steps
 from .preloader import (
     detect_yolo_model,
     preload_yolo,
     preload_tagger,
     preload_realesrgan,
-    get as get_model,
+    registry,
 )
 
+if TYPE_CHECKING:  # pragma: no cover - torch is only imported when a model runs
+    import numpy as np
+    import torch
+
+
+def _torch_device() -> "torch.device":
+    """Return the CUDA device if available, otherwise the CPU."""
+    import torch
+
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
 
 class Pipeline:
     def __init__(
@@ -33,6 +45,8 @@ class Pipeline:
         *,
         yolo_model: Path | None = None,
         preload: bool | None = None,
+        cache_dir: Path | bool | None = None,
+        hash_index: Path | bool | None = None,
     ) -> None:
         self.input_dir = input_dir
         self.output_dir = output_dir
@@ -45,10 +59,122 @@ class Pipeline:
         env_preload = os.getenv("DSK_PRELOAD", "1")
         self.preload = preload if preload is not None else env_preload != "0"
 
+        # Cross-job result cache, configured here or via ``DSK_CACHE_DIR``;
+        # ``False`` disables it regardless of the environment.
+        self.cache = ResultCache.from_env(cache_dir) if cache_dir is not False else None
+        # Hashes of frames kept by earlier jobs, configured here or via
+        # ``DSK_HASH_INDEX``; ``False`` disables it as well.
+        self.hash_index = PersistentHashIndex.from_env(hash_index) if hash_index is not False else None
+        # Identity of the job input and name and hash of every frame kept
+        # by deduplication in the current run.
+        self._source: str | None = None
+        self._kept_hashes: dict[str, str] = {}
+
+        # Write ``<output>.prom`` next to the metrics report when set.
+        self.prometheus = os.getenv("DSK_METRICS_PROM", "0") != "0"
+        self.metrics = Metrics()
+        # Identity of the input of the next file mode stage, see ``_begin_stage``.
+        self._upstream: str | StageManifest | None = None
+
     def cleanup(self):
         if self.work_dir.exists():
             shutil.rmtree(self.work_dir)
 
+    def _detection_index(self) -> "steps.cropping.DetectionIndex":
+        """Return the raw face detections kept next to the output across runs."""
+        return steps.cropping.DetectionIndex(self.output_dir.with_suffix('.detections.json'))
+
+    def _hash_index_path(self) -> str | None:
+        return str(self.hash_index.path) if self.hash_index is not None else None
+
+    def _remove_intermediate(self, path: Path) -> None:
+        """Delete the output of a finished stage, never the job input."""
+        if path.exists() and path.is_relative_to(self.work_dir):
+            shutil.rmtree(path)
+
+    def _source_digests(self, source: Path | None, resume: bool) -> tuple[str | None, str | None]:
+        """Return the exact and the location independent digest of the job input.
+
+        The digests are kept in ``work_dir/manifests`` so a resumed run can
+        still identify an input that is no longer there.
+        """
+        stored = self.work_dir / 'manifests' / 'source.json'
+        if source is not None and source.exists():
+            digests = (source_digest(source), source_digest(source, exact=False))
+            stored.parent.mkdir(parents=True, exist_ok=True)
+            stored.write_text(json.dumps(digests))
+            return digests
+        if resume and stored.exists():
+            log_step(f'Input {source} not found, using the digest of the interrupted run')
+            exact, relocatable = json.loads(stored.read_text())
+            return exact, relocatable
+        return None, None
+
+    def _seen_hashes(self) -> "np.ndarray | None":
+        """Return the hashes kept by earlier jobs on other inputs."""
+        return self.hash_index.load(exclude=self._source) if self.hash_index is not None else None
+
+    def _kept_hashes_path(self) -> Path:
+        return self.work_dir / 'manifests' / 'dedup_hashes.json'
+
+    def _save_kept_hashes(self) -> None:
+        """Keep the hashes of deduplicated frames for a resumed run."""
+        self._kept_hashes_path().write_text(json.dumps(self._kept_hashes))
+
+    def _load_kept_hashes(self) -> None:
+        path = self._kept_hashes_path()
+        self._kept_hashes = json.loads(path.read_text()) if path.exists() else {}
+
+    def _output_hashes(self) -> list[str]:
+        """Return the hashes of the deduplicated frames that reached ``output_dir/images``.
+
+        Crops are traced back to their frame by name, a frame with several
+        faces yields ``<stem>_NN.png``.
+        """
+        names = set()
+        for path in (self.output_dir / 'images').rglob('*.png'):
+            name = path.name
+            if name not in self._kept_hashes:
+                name = re.sub(r'_\d+(\.png)$', r'\1', name)
+            names.add(name)
+        return [phash for name, phash in self._kept_hashes.items() if name in names]
+
+    def _package_and_remember(self, progress_cb: Callable[[int, str], None] | None) -> Path:
+        """Package the output and add its frames to the persistent hash index.
+
+        The index is only updated once packaging succeeded, so frames of
+        failed jobs or frames dropped by a later stage never block future
+        jobs.
+        """
+        hashes = self._output_hashes() if self.hash_index is not None else []
+        zip_path = self._package(progress_cb)
+        if hashes:
+            added = self.hash_index.append(hashes, source=self._source)
+            log_step(f'Added {added} hashes to {self.hash_index.path}')
+        return zip_path
+
+    def _model(self, name: str, *args: Any) -> Any:
+        """Return a model from the shared registry, or ``None`` to let the step load it."""
+        return registry.get(name, *args) if self.preload else None
+
+    def _begin_stage(self, stage: str, workdir: Path, resume: bool, **params: Any) -> StageManifest:
+        """Return the manifest for ``stage`` and drop outputs it cannot reuse.
+
+        The digest of the previous stage's manifest (or of the job input for
+        the first stage) is part of the parameters, so a stage is only resumed
+        when its inputs are the ones it processed before. Stages must begin
+        in pipeline order.
+        """
+        upstream = self._upstream
+        if isinstance(upstream, StageManifest):
+            upstream = upstream.digest()
+        params['upstream'] = upstream
+        manifest = StageManifest(self.work_dir / 'manifests' / f'{stage}.jsonl', params, resume=resume)
+        self._upstream = manifest
+        if not manifest.resumed and workdir.exists():
+            shutil.rmtree(workdir)
+        return manifest
+
     def run(
         self,
         video_path: Path | None = None,
@@ -58,11 +184,19 @@ class Pipeline:
         progress_cb: Callable[[int, str], None] | None = None,
         fps: int = 1,
         dedup_threshold: int = 8,
+        dedup_window: int | None = None,
         scale: int = 4,
+        upscale_batch: int = 4,
+        upscale_tile: int = 256,
+        upscale_backend: str | None = None,
+        torch_threads: int | None = None,
         blur_threshold: float = 100.0,
         dark_threshold: float = 40.0,
+        qc_max_side: int | None = None,
+        crop_first: bool = False,
         margin: float = 0.3,
         conf_threshold: float = 0.5,
+        detect_max_side: int | None = 640,
         batch_size: int = 4,
         skip_deduplication: bool = False,
         skip_filtering: bool = False,
@@ -70,6 +204,15 @@ class Pipeline:
         skip_cropping: bool = False,
         skip_annotation: bool = False,
         skip_classification: bool = False,
+        streaming: bool = False,
+        pipelined: bool = False,
+        queue_size: int = 8,
+        resume: bool = False,
+        workers: int | None = None,
+        extract_segments: int = 1,
+        extract_mode: str = "fps",
+        scene_threshold: float = 0.3,
+        max_per_scene: int = 1,
     ):
         """Execute the full pipeline.
 
@@ -86,37 +229,149 @@ class Pipeline:
             Frames per second for extraction.
         dedup_threshold:
             Hamming distance for deduplication.
+        dedup_window:
+            Only compare frames against the last ``dedup_window`` kept
+            frames during deduplication. ``None`` compares against all.
         scale:
             Upscaling factor.
+        upscale_batch:
+            Frames of the same size upscaled together by RealESRGAN.
+        upscale_tile:
+            Upscale frames in tiles of this size to bound memory, ``0``
+            upscales whole frames.
+        upscale_backend:
+            ``"torch"`` or ``"onnx"``. Defaults to ``DSK_UPSCALE_BACKEND`` or
+            ``"torch"``.
+        torch_threads:
+            Intra-op threads of the upscaler (torch or the ONNX session).
+            Defaults to ``DSK_TORCH_THREADS`` or the library default.
         blur_threshold:
             Minimum Laplacian variance to keep a frame.
         dark_threshold:
             Minimum brightness level.
+        qc_max_side:
+            Reduce frames to at most this many pixels on the longer side
+            before the quality checks. ``None`` checks the full resolution.
+        crop_first:
+            Detect and crop faces on the original frames and upscale only
+            the crops instead of upscaling full frames before cropping.
         margin:
             Extra border around detected faces.
         conf_threshold:
             YOLO confidence threshold.
+        detect_max_side:
+            Detect faces on a copy of each image shrunk to at most this many
+            pixels on the longer side. ``None`` detects at full resolution.
         batch_size:
             How many images to process per YOLO batch.
+        streaming:
+            Pass decoded images from stage to stage in memory instead of
+            writing every intermediate stage to ``work_dir``. Only the final
+            images and captions are written.
+        pipelined:
+            Run every stage in its own thread connected by bounded queues so
+            the stages overlap. Implies ``streaming``.
+        queue_size:
+            Maximum number of images waiting between two pipelined stages.
+        resume:
+            Continue an interrupted run. Every stage keeps a manifest of the
+            images it processed in ``work_dir/manifests``; finished stages and
+            already processed images are skipped. The work directory is kept
+            when the run fails so it can be resumed later.
+        workers:
+            Number of processes for the CPU bound parts of deduplication,
+            quality checks, animeface/mediapipe cropping and tagger
+            preprocessing. Defaults to ``DSK_WORKERS`` or ``1``.
+        extract_segments:
+            Decode the video in this many time segments with concurrent
+            ffmpeg processes. The frames are then written to ``work_dir``
+            before deduplication instead of being deduplicated from a single
+            ffmpeg pipe.
+        extract_mode:
+            ``"fps"`` samples ``fps`` frames per second, ``"scene"`` takes
+            frames after scene cuts and ``"keyframes"`` only the key frames.
+        scene_threshold:
+            Scene score (0-1) that starts a new scene in ``"scene"`` mode.
+        max_per_scene:
+            Frames taken per scene in ``"scene"`` mode, ``1/fps`` seconds apart.
         """
+        keep_work = False
+        extract = dict(mode=extract_mode, scene_threshold=scene_threshold, max_per_scene=max_per_scene)
+        if workers is None:
+            workers = default_workers()
+        self.metrics = Metrics()
+        self.metrics.start()
         try:
-            device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+            if resume and (streaming or pipelined):
+                raise ValueError('resume is not supported in streaming mode')
+            # Only the preloaded models need a device, the steps pick their own.
+            device = None
+            if self.preload and not (skip_upscaling and skip_annotation and skip_classification):
+                device = _torch_device()
             if self.preload:
-                preload_realesrgan(device, 4)
-                preload_yolo(self.yolo_model)
-                preload_tagger(device)
+                # Only warm up the models of stages that will actually run.
+                if not skip_upscaling:
+                    preload_realesrgan(device, scale, upscale_backend, torch_threads)
+                if not skip_cropping:
+                    preload_yolo(self.yolo_model)
+                if not (skip_annotation and skip_classification):
+                    preload_tagger(device)
 
             if progress_cb:
                 progress_cb(0, 'Starting')
-            if self.output_dir.exists():
+            if self.output_dir.exists() and not resume:
                 shutil.rmtree(self.output_dir)
             zip_path = self.output_dir.with_suffix('.zip')
             if zip_path.exists():
                 zip_path.unlink()
-            if self.work_dir.exists():
+            if self.work_dir.exists() and not resume:
                 shutil.rmtree(self.work_dir)
             self.output_dir.mkdir(parents=True, exist_ok=True)
 
+            self._upstream, self._source = self._source_digests(
+                images_dir if images_dir is not None else video_path, resume
+            )
+            self._kept_hashes = {}
+
+            if streaming or pipelined:
+                self._run_streaming(
+                    video_path,
+                    images_dir,
+                    device=device,
+                    progress_cb=progress_cb,
+                    trigger_word=trigger_word,
+                    fps=fps,
+                    extract=extract,
+                    dedup_threshold=dedup_threshold,
+                    dedup_window=dedup_window,
+                    scale=scale,
+                    upscale_batch=upscale_batch,
+                    upscale_tile=upscale_tile,
+                    upscale_backend=upscale_backend,
+                    torch_threads=torch_threads,
+                    blur_threshold=blur_threshold,
+                    dark_threshold=dark_threshold,
+                    qc_max_side=qc_max_side,
+                    crop_first=crop_first,
+                    margin=margin,
+                    conf_threshold=conf_threshold,
+                    detect_max_side=detect_max_side,
+                    batch_size=batch_size,
+                    skip_deduplication=skip_deduplication,
+                    skip_filtering=skip_filtering,
+                    skip_upscaling=skip_upscaling,
+                    skip_cropping=skip_cropping,
+                    skip_annotation=skip_annotation,
+                    skip_classification=skip_classification,
+                    pipelined=pipelined,
+                    queue_size=queue_size,
+                )
+                return self._package_and_remember(progress_cb)
+
+            # Frames of a video are deduplicated straight from the ffmpeg
+            # pipe so duplicates are never written to disk.
+            fuse_extraction = images_dir is None and not skip_deduplication and extract_segments <= 1
+            current: Path | None = None
             if images_dir is not None:
                 if progress_cb:
                     progress_cb(1, 'Frame Extraction (skipped)')
@@ -126,9 +381,22 @@ class Pipeline:
                     raise ValueError('Either video_path or images_dir must be provided')
                 if progress_cb:
                     progress_cb(1, 'Frame Extraction')
-                work_frames = self.work_dir / 'frames'
-                frames = frame_extraction.run(video_path, work_frames, fps=fps)
-                current = frames
+                if not fuse_extraction:
+                    work_frames = self.work_dir / 'frames'
+                    manifest = self._begin_stage(
+                        'frame_extraction', work_frames, resume, video=video_path, fps=fps, **extract
+                    )
+                    if manifest.completed:
+                        log_step('Frame Extraction already completed, skipping')
+                    else:
+                        if work_frames.exists():
+                            shutil.rmtree(work_frames)
+                        with self.metrics.stage('Frame Extraction', None, work_frames):
+                            steps.frame_extraction.run(
+                                video_path, work_frames, fps=fps, segments=extract_segments, **extract
+                            )
+                        manifest.complete()
+                    current = work_frames
 
             # Deduplication
             work_dedup = self.work_dir / 'dedup'
@@ -136,12 +404,60 @@ class Pipeline:
                 if progress_cb:
                     progress_cb(2, 'Deduplication (skipped)')
                 deduped = current
+            elif fuse_extraction:
+                if progress_cb:
+                    progress_cb(2, 'Deduplication')
+                manifest = self._begin_stage(
+                    'deduplication',
+                    work_dedup,
+                    resume,
+                    video=video_path,
+                    fps=fps,
+                    threshold=dedup_threshold,
+                    window=dedup_window,
+                    hash_index=self._hash_index_path(),
+                    **extract,
+                )
+                if manifest.completed:
+                    log_step('Deduplication already completed, skipping')
+                    self._load_kept_hashes()
+                else:
+                    self._extract_deduplicated(
+                        video_path, work_dedup, fps, dedup_threshold, dedup_window, extract
+                    )
+                    self._save_kept_hashes()
+                    manifest.complete()
+                current = work_dedup
             else:
                 if progress_cb:
                     progress_cb(2, 'Deduplication')
-                deduped = deduplication.run(current, work_dedup, threshold=dedup_threshold)
-                shutil.rmtree(current)
-                current = deduped
+                manifest = self._begin_stage(
+                    'deduplication',
+                    work_dedup,
+                    resume,
+                    threshold=dedup_threshold,
+                    window=dedup_window,
+                    hash_index=self._hash_index_path(),
+                )
+                if manifest.completed:
+                    log_step('Deduplication already completed, skipping')
+                    self._load_kept_hashes()
+                else:
+                    with self.metrics.stage('Deduplication', current, work_dedup):
+                        steps.deduplication.run(
+                            current,
+                            work_dedup,
+                            threshold=dedup_threshold,
+                            manifest=manifest,
+                            workers=workers,
+                            window=dedup_window,
+                            seen=self._seen_hashes(),
+                            kept=self._kept_hashes,
+                        )
+                    self._save_kept_hashes()
+                    manifest.complete()
+                self._remove_intermediate(current)
+                current = work_dedup
 
             # Filtering
             work_filter = self.work_dir / 'filtering'
@@ -152,52 +468,122 @@ class Pipeline:
             else:
                 if progress_cb:
                     progress_cb(3, 'Filtering')
-                filtered = filtering.run(current, work_filter)
-                shutil.rmtree(current)
-                current = filtered
-
-            # Upscaling
-            work_upscale = self.work_dir / 'upscaling'
-            if skip_upscaling:
-                if progress_cb:
-                    progress_cb(4, 'Upscaling (skipped)')
-                upscaled = current
-            else:
-                if progress_cb:
-                    progress_cb(4, 'Upscaling')
-                upscaled = upscaling.run(
-                    current,
-                    work_upscale,
-                    scale=scale,
+                manifest = self._begin_stage(
+                    'filtering',
+                    work_filter,
+                    resume,
                     blur_threshold=blur_threshold,
                     dark_threshold=dark_threshold,
-                    model=get_model("realesrgan") if self.preload else None,
-                    device=device,
+                    max_side=qc_max_side,
                 )
-                shutil.rmtree(current)
-                current = upscaled
+                if manifest.completed:
+                    log_step('Filtering already completed, skipping')
+                else:
+                    with self.metrics.stage('Filtering', current, work_filter):
+                        steps.filtering.run(
+                            current,
+                            work_filter,
+                            blur_threshold=blur_threshold,
+                            dark_threshold=dark_threshold,
+                            max_side=qc_max_side,
+                            manifest=manifest,
+                            workers=workers,
+                        )
+                    manifest.complete()
+                self._remove_intermediate(current)
+                current = work_filter
 
-            # Cropping
-            work_crop = self.work_dir / 'cropping'
-            if skip_cropping:
-                if progress_cb:
-                    progress_cb(5, 'Cropping (skipped)')
-                cropped = current
-            else:
-                if progress_cb:
-                    progress_cb(5, 'Cropping')
-                cropped = cropping.run(
-                    current,
-                    work_crop,
-                    margin=margin,
-                    yolo_model=self.yolo_model,
-                    yolo=get_model("yolo") if self.preload else None,
-                    conf_threshold=conf_threshold,
-                    batch_size=batch_size,
-                )
-                shutil.rmtree(current)
-                current = cropped
+            # Upscaling and cropping, cropping first upscales only the crops.
+            order = ('cropping', 'upscaling') if crop_first else ('upscaling', 'cropping')
+            # Frame digests of the upscaled images, which key the detection index.
+            upscale_sources: dict[str, str] | None = None
+            for position, stage in enumerate(order, 4):
+                if stage == 'upscaling':
+                    work_upscale = self.work_dir / 'upscaling'
+                    if skip_upscaling:
+                        if progress_cb:
+                            progress_cb(position, 'Upscaling (skipped)')
+                        upscaled = current
+                    else:
+                        if progress_cb:
+                            progress_cb(position, 'Upscaling')
+                        manifest = self._begin_stage(
+                            'upscaling',
+                            work_upscale,
+                            resume,
+                            scale=scale,
+                            crop_first=crop_first,
+                            backend=upscale_backend,
+                        )
+                        if manifest.completed:
+                            log_step('Upscaling already completed, skipping')
+                        else:
+                            with self.metrics.stage('Upscaling', current, work_upscale):
+                                steps.upscaling.run(
+                                    current,
+                                    work_upscale,
+                                    scale=scale,
+                                    model=self._model("realesrgan", device, scale, upscale_backend, torch_threads),
+                                    device=device,
+                                    manifest=manifest,
+                                    cache=self.cache,
+                                    batch_size=upscale_batch,
+                                    tile=upscale_tile,
+                                    backend=upscale_backend,
+                                    threads=torch_threads,
+                                )
+                            manifest.complete()
+                        upscale_sources = {
+                            Path(entry['outputs'][0]).name: entry['source']
+                            for entry in manifest.entries.values()
+                            if entry['outputs'] and 'source' in entry
+                        }
+                        self._remove_intermediate(current)
+                        current = work_upscale
+                else:
+                    work_crop = self.work_dir / 'cropping'
+                    if skip_cropping:
+                        if progress_cb:
+                            progress_cb(position, 'Cropping (skipped)')
+                        cropped = current
+                    else:
+                        if progress_cb:
+                            progress_cb(position, 'Cropping')
+                        manifest = self._begin_stage(
+                            'cropping',
+                            work_crop,
+                            resume,
+                            margin=margin,
+                            yolo_model=self.yolo_model,
+                            conf_threshold=conf_threshold,
+                            crop_first=crop_first,
+                            detect_max_side=detect_max_side,
+                        )
+                        if manifest.completed:
+                            log_step('Cropping already completed, skipping')
+                        else:
+                            with self.metrics.stage('Cropping', current, work_crop):
+                                steps.cropping.run(
+                                    current,
+                                    work_crop,
+                                    margin=margin,
+                                    yolo_model=self.yolo_model,
+                                    yolo=self._model("yolo", self.yolo_model),
+                                    conf_threshold=conf_threshold,
+                                    batch_size=batch_size,
+                                    manifest=manifest,
+                                    cache=self.cache,
+                                    workers=workers,
+                                    detect_max_side=detect_max_side,
+                                    index=self._detection_index(),
+                                    sources=upscale_sources,
+                                )
+                            manifest.complete()
+                        self._remove_intermediate(current)
+                        current = work_crop
 
+            # Raw tagger scores, computed once and shared by both steps.
+            tag_scores = TagScoreStore(self.work_dir / 'tag_scores')
             captions_dir = self.output_dir / 'captions'
             if skip_annotation:
                 if progress_cb:
@@ -205,12 +591,22 @@ class Pipeline:
             else:
                 if progress_cb:
                     progress_cb(6, 'Annotation')
-                annotation.run(
-                    current,
-                    captions_dir,
-                    trigger_word=trigger_word,
-                    preloaded=get_model("tagger") if self.preload else None,
-                )
+                manifest = self._begin_stage('annotation', captions_dir, resume, trigger_word=trigger_word)
+                if manifest.completed:
+                    log_step('Annotation already completed, skipping')
+                else:
+                    with self.metrics.stage('Annotation', current, captions_dir):
+                        steps.annotation.run(
+                            current,
+                            captions_dir,
+                            trigger_word=trigger_word,
+                            preloaded=self._model("tagger", device),
+                            manifest=manifest,
+                            cache=self.cache,
+                            workers=workers,
+                            scores=tag_scores,
+                        )
+                    manifest.complete()
 
             work_class = self.work_dir / 'classification'
             if skip_classification:
@@ -220,33 +616,257 @@ class Pipeline:
             else:
                 if progress_cb:
                     progress_cb(7, 'Classification')
-                classified = classification.run(
-                    current,
-                    work_class,
-                    preloaded=get_model("tagger") if self.preload else None,
-                )
-                shutil.rmtree(current)
-                current = classified
+                manifest = self._begin_stage('classification', work_class, resume)
+                if manifest.completed:
+                    log_step('Classification already completed, skipping')
+                else:
+                    with self.metrics.stage('Classification', current, work_class):
+                        steps.classification.run(
+                            current,
+                            work_class,
+                            preloaded=self._model("tagger", device),
+                            manifest=manifest,
+                            cache=self.cache,
+                            scores=tag_scores,
+                        )
+                    manifest.complete()
+                self._remove_intermediate(current)
+                current = work_class
 
             images_dir = self.output_dir / 'images'
-            shutil.copytree(current, images_dir)
-            if current.exists() and current != images_dir:
-                shutil.rmtree(current)
+            link_tree(current, images_dir)
+            self._remove_intermediate(current)
             if work_crop.exists() and not skip_cropping:
                 shutil.rmtree(work_crop)
 
-            # Zip output
-            if progress_cb:
-                progress_cb(8, 'Packaging')
-            zip_path = self.output_dir.with_suffix('.zip')
-            with zipfile.ZipFile(zip_path, 'w') as zf:
-                for path in self.output_dir.rglob('*'):
-                    zf.write(path, path.relative_to(self.output_dir))
-            shutil.rmtree(self.output_dir)
-            log_step(f'Pipeline completed successfully: {zip_path}')
-            return zip_path
+            return self._package_and_remember(progress_cb)
         except Exception as e:
             log_step(f'Pipeline failed: {e}')
+            if resume:
+                keep_work = True
+                log_step(f'Keeping {self.work_dir} so the run can be resumed')
             raise
         finally:
-            self.cleanup()
+            self.metrics.stop()
+            if not keep_work:
+                self.cleanup()
+            if self.cache is not None:
+                log_step(f'Result cache: {self.cache.hits} hits, {self.cache.misses} misses')
+                self.cache.trim()
+
+    def _package(self, progress_cb: Callable[[int, str], None] | None) -> Path:
+        """Zip ``output_dir`` next to itself and remove the directory."""
+        if progress_cb:
+            progress_cb(8, 'Packaging')
+        zip_path = self.output_dir.with_suffix('.zip')
+        with zipfile.ZipFile(zip_path, 'w') as zf:
+            for path in self.output_dir.rglob('*'):
+                zf.write(path, path.relative_to(self.output_dir))
+        shutil.rmtree(self.output_dir)
+        self._write_metrics(zip_path)
+        log_step(f'Pipeline completed successfully: {zip_path}')
+        return zip_path
+
+    def _write_metrics(self, zip_path: Path) -> None:
+        """Write the run metrics as ``<output>.metrics.json`` (and ``.prom``)."""
+        self.metrics.stop()
+        self.metrics.models = registry.stats() if self.preload else {}
+        self.metrics.write_json(zip_path.with_suffix('.metrics.json'))
+        if self.prometheus:
+            zip_path.with_suffix('.prom').write_text(self.metrics.to_prometheus())
+        for name, stage in self.metrics.report()['stages'].items():
+            log_step(
+                f"{name}: {stage['wall_seconds']:.1f}s, {stage['images_per_second']:.2f} img/s, "
+                f"inference {stage['inference_seconds']:.1f}s, peak RSS {stage['peak_rss_bytes'] / 1024**2:.0f} MB"
+            )
+
+    def _extract_deduplicated(
+        self,
+        video_path: Path,
+        workdir: Path,
+        fps: int,
+        threshold: int,
+        window: int | None,
+        extract: dict[str, Any],
+    ) -> None:
+        """Write only the frames of ``video_path`` that deduplication keeps to ``workdir``."""
+        if workdir.exists():
+            shutil.rmtree(workdir)
+        total = steps.frame_extraction.estimate_frames(video_path, fps, extract['mode'])
+        records = self.metrics.track('Frame Extraction', steps.frame_extraction.stream(video_path, fps, **extract))
+        deduped = steps.deduplication.stream(
+            records, threshold, window=window, seen=self._seen_hashes(), kept=self._kept_hashes, total=total
+        )
+        records = self.metrics.track('Deduplication', deduped)
+        kept = drain(self.metrics.track('Write', save_records(records, workdir), output_dir=workdir))
+        log_step(f'Kept {kept} unique frames')
+
+    def _run_streaming(
+        self,
+        video_path: Path | None,
+        images_dir: Path | None,
+        *,
+        device: "torch.device | None",
+        progress_cb: Callable[[int, str], None] | None,
+        trigger_word: str,
+        fps: int,
+        extract: dict[str, Any],
+        dedup_threshold: int,
+        dedup_window: int | None,
+        scale: int,
+        upscale_batch: int,
+        upscale_tile: int,
+        upscale_backend: str | None,
+        torch_threads: int | None,
+        blur_threshold: float,
+        dark_threshold: float,
+        qc_max_side: int | None,
+        crop_first: bool,
+        margin: float,
+        conf_threshold: float,
+        detect_max_side: int | None,
+        batch_size: int,
+        skip_deduplication: bool,
+        skip_filtering: bool,
+        skip_upscaling: bool,
+        skip_cropping: bool,
+        skip_annotation: bool,
+        skip_classification: bool,
+        pipelined: bool,
+        queue_size: int,
+    ) -> None:
+        """Chain the step generators and write only the final outputs.
+
+        With ``pipelined`` every stage runs in its own thread and hands its
+        results to the next one through a queue of ``queue_size`` images.
+        """
+        def _stage(name, recs, source=None):
+            recs = self.metrics.track(name, recs, source)
+            return background(recs, queue_size) if pipelined else recs
+
+        if images_dir is not None:
+            if progress_cb:
+                progress_cb(1, 'Frame Extraction (skipped)')
+            # The directory steps only flatten sub folders in filtering, which
+            # directly reads the source when deduplication is skipped.
+            recursive = skip_deduplication and not skip_filtering
+            total = count_images(images_dir, recursive=recursive)
+            records = _stage('Decode', load_records(images_dir, recursive=recursive), images_dir)
+        else:
+            if video_path is None:
+                raise ValueError('Either video_path or images_dir must be provided')
+            if progress_cb:
+                progress_cb(1, 'Frame Extraction')
+            total = steps.frame_extraction.estimate_frames(video_path, fps, extract['mode'])
+            records = _stage('Frame Extraction', steps.frame_extraction.stream(video_path, fps, **extract))
+
+        if skip_deduplication:
+            if progress_cb:
+                progress_cb(2, 'Deduplication (skipped)')
+        else:
+            if progress_cb:
+                progress_cb(2, 'Deduplication')
+            records = _stage(
+                'Deduplication',
+                steps.deduplication.stream(
+                    records,
+                    dedup_threshold,
+                    window=dedup_window,
+                    seen=self._seen_hashes(),
+                    kept=self._kept_hashes,
+                    total=total,
+                ),
+            )
+
+        if skip_filtering:
+            if progress_cb:
+                progress_cb(3, 'Filtering (skipped)')
+        else:
+            if progress_cb:
+                progress_cb(3, 'Filtering')
+            records = _stage(
+                'Filtering',
+                steps.filtering.stream(
+                    records,
+                    blur_threshold=blur_threshold,
+                    dark_threshold=dark_threshold,
+                    max_side=qc_max_side,
+                    total=total,
+                ),
+            )
+
+        order = ('cropping', 'upscaling') if crop_first else ('upscaling', 'cropping')
+        for position, stage in enumerate(order, 4):
+            if stage == 'upscaling':
+                if skip_upscaling:
+                    if progress_cb:
+                        progress_cb(position, 'Upscaling (skipped)')
+                else:
+                    if progress_cb:
+                        progress_cb(position, 'Upscaling')
+                    records = steps.upscaling.stream(
+                        records,
+                        scale=scale,
+                        model=self._model("realesrgan", device, scale, upscale_backend, torch_threads),
+                        device=device,
+                        cache=self.cache,
+                        batch_size=upscale_batch,
+                        tile=upscale_tile,
+                        backend=upscale_backend,
+                        threads=torch_threads,
+                        # Crops outnumber the frames counted in ``total``.
+                        total=None if crop_first else total,
+                    )
+                    records = _stage('Upscaling', records)
+            else:
+                if skip_cropping:
+                    if progress_cb:
+                        progress_cb(position, 'Cropping (skipped)')
+                else:
+                    if progress_cb:
+                        progress_cb(position, 'Cropping')
+                    records = steps.cropping.stream(
+                        records,
+                        margin=margin,
+                        yolo_model=self.yolo_model,
+                        yolo=self._model("yolo", self.yolo_model),
+                        conf_threshold=conf_threshold,
+                        batch_size=batch_size,
+                        cache=self.cache,
+                        detect_max_side=detect_max_side,
+                        index=self._detection_index(),
+                        total=total,
+                    )
+                    records = _stage('Cropping', records)
+
+        if skip_annotation:
+            if progress_cb:
+                progress_cb(6, 'Annotation (skipped)')
+        else:
+            if progress_cb:
+                progress_cb(6, 'Annotation')
+            records = steps.annotation.stream(
+                records,
+                self.output_dir / 'captions',
+                trigger_word=trigger_word,
+                preloaded=self._model("tagger", device),
+                cache=self.cache,
+            )
+            records = _stage('Annotation', records)
+
+        if skip_classification:
+            if progress_cb:
+                progress_cb(7, 'Classification (skipped)')
+        else:
+            if progress_cb:
+                progress_cb(7, 'Classification')
+            records = steps.classification.stream(
+                records,
+                preloaded=self._model("tagger", device),
+                cache=self.cache,
+            )
+            records = _stage('Classification', records)
+
+        images_out = self.output_dir / 'images'
+        written = drain(self.metrics.track('Write', save_records(records, images_out), output_dir=images_out))
+        log_step(f'Streaming pipeline wrote {written} images')
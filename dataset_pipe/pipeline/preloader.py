@@ -1,20 +1,214 @@
 from __future__ import annotations
 
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass, field
+import os
 from pathlib import Path
-from typing import Any
-
-import torch
-from ultralytics import YOLO
+import threading
+import time
+import sys
+from typing import TYPE_CHECKING, Any, Callable
 
 from .logging_utils import log_step
-from .steps.annotation import _load_tagger
-from .steps.upscaling import _load_model
+from .metrics import rss_bytes
+
+if TYPE_CHECKING:  # pragma: no cover - imported lazily by the loaders
+    import torch
+    from ultralytics import YOLO
 
 MODELS_DIR = Path("models")
 
 _executor = ThreadPoolExecutor(max_workers=3)
-_futures: dict[str, Future[Any]] = {}
+
+
+def _model_bytes(model: Any) -> int | None:
+    """Return the parameter and buffer size of a model if it can be determined."""
+
+    if isinstance(model, tuple):  # the tagger is ``(session, size, tags)``
+        path = getattr(model[0], "_model_path", None)
+        if path and os.path.exists(path):
+            return os.path.getsize(path)
+        return None
+    if "torch" not in sys.modules:  # nothing to measure without torch
+        return None
+    import torch
+
+    module = model if isinstance(model, torch.nn.Module) else getattr(model, "model", None)
+    if isinstance(module, torch.nn.Module):
+        tensors = list(module.parameters()) + list(module.buffers())
+        return sum(t.numel() * t.element_size() for t in tensors)
+    return None
+
+
+@dataclass
+class _Entry:
+    args: tuple
+    future: Future
+    load_seconds: float = 0.0
+    size_bytes: int = 0
+    loaded: bool = False
+    last_used: float = field(default_factory=time.monotonic)
+
+
+class ModelRegistry:
+    """Lazily loaded models kept in memory within a size budget.
+
+    Loaders are registered by name and only run when a model is requested,
+    either in the background with :meth:`preload` or on demand with
+    :meth:`get`. Each load is timed and its resident size recorded. When the
+    total size exceeds ``budget_bytes`` the least recently used models are
+    dropped. Requesting a model with different arguments (e.g. another
+    upscaling factor) replaces the loaded instance.
+    """
+
+    def __init__(self, budget_bytes: int | None = None) -> None:
+        self.budget_bytes = budget_bytes
+        self._loaders: dict[str, Callable[..., Any]] = {}
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, name: str, loader: Callable[..., Any]) -> None:
+        self._loaders[name] = loader
+
+    def _load(self, name: str, args: tuple) -> Any:
+        rss_before = rss_bytes()
+        start = time.perf_counter()
+        model = self._loaders[name](*args)
+        elapsed = time.perf_counter() - start
+        size = _model_bytes(model)
+        if size is None:
+            size = max(0, rss_bytes() - rss_before)
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and entry.args == args:
+                entry.load_seconds = elapsed
+                entry.size_bytes = size
+                entry.loaded = True
+        log_step(f"Loaded {name} in {elapsed:.1f}s ({size / 1024**2:.0f} MB)")
+        return model
+
+    @staticmethod
+    def _failed(future: Future) -> bool:
+        """Return ``True`` if the load behind ``future`` was cancelled or raised.
+
+        ``None`` is a valid result, e.g. without RealESRGAN or YOLO weights.
+        """
+
+        if not future.done():
+            return False
+        return future.cancelled() or future.exception() is not None
+
+    def preload(self, name: str, *args: Any) -> Future:
+        """Start loading ``name`` in the background unless it is already loaded.
+
+        A load that raised (e.g. after a failed weight download) is not kept,
+        the next request loads the model again. The memory budget is checked
+        whenever a load finishes.
+        """
+
+        with self._lock:
+            entry = self._entries.get(name)
+            started = entry is None or entry.args != args or self._failed(entry.future)
+            if started:
+                entry = _Entry(args, _executor.submit(self._load, name, args))
+                self._entries[name] = entry
+            self._entries.move_to_end(name)
+            entry.last_used = time.monotonic()
+        if started:
+            # Runs right away if the load already finished, so not under the lock.
+            entry.future.add_done_callback(lambda _: self._enforce_budget(keep=name))
+        return entry.future
+
+    def get(self, name: str, *args: Any) -> Any:
+        """Return model ``name`` loaded with ``args``, loading it if necessary."""
+
+        return self.preload(name, *args).result()
+
+    def peek(self, name: str) -> Any:
+        """Return model ``name`` if it was requested before, otherwise ``None``."""
+
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            self._entries.move_to_end(name)
+            entry.last_used = time.monotonic()
+        return entry.future.result()
+
+    def evict(self, name: str) -> None:
+        with self._lock:
+            entry = self._entries.pop(name, None)
+        if entry is not None:
+            log_step(f"Evicted {name} ({entry.size_bytes / 1024**2:.0f} MB)")
+            torch = sys.modules.get("torch")
+            if torch is not None and torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def _enforce_budget(self, keep: str) -> None:
+        if self.budget_bytes is None:
+            return
+        while True:
+            with self._lock:
+                # Sizes are recorded by ``_load`` before its future resolves, so
+                # models finishing concurrently are all counted.
+                loaded = [(n, e) for n, e in self._entries.items() if e.loaded]
+                total = sum(e.size_bytes for _, e in loaded)
+                victims = [n for n, _ in loaded if n != keep]
+            if total <= self.budget_bytes or not victims:
+                return
+            self.evict(victims[0])
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        """Return load time and resident size of every loaded model."""
+
+        with self._lock:
+            return {
+                name: {"load_seconds": e.load_seconds, "size_bytes": e.size_bytes}
+                for name, e in self._entries.items()
+                if e.future.done()
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+def _budget_from_env() -> int | None:
+    budget_mb = os.getenv("DSK_MODEL_BUDGET_MB")
+    return int(float(budget_mb) * 1024**2) if budget_mb else None
+
+
+def _load_yolo(model_path: Path | None) -> YOLO | None:
+    if model_path is None:
+        return None
+    import torch
+    from ultralytics import YOLO
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    log_step("Loading YOLO model")
+    return YOLO(str(model_path)).to(device)
+
+
+def _load_tagger(device: torch.device | None = None) -> Any:
+    # Step modules are imported on first use, like the rest of ``steps``.
+    from .steps.annotation import _load_tagger
+
+    return _load_tagger(device)
+
+
+def _load_realesrgan(
+    device: torch.device | None, scale: int, backend: str | None = None, threads: int | None = None
+) -> Any:
+    from .steps.upscaling import _load_model
+
+    return _load_model(device, scale, backend, threads)
+
+
+registry = ModelRegistry(_budget_from_env())
+registry.register("yolo", _load_yolo)
+registry.register("tagger", _load_tagger)
+registry.register("realesrgan", _load_realesrgan)
 
 
 def detect_yolo_model() -> Path | None:
@@ -32,45 +226,31 @@ def detect_yolo_model() -> Path | None:
 
 def preload_yolo(model_path: Path | None) -> Future[Any]:
     """Start loading a YOLO model in the background."""
-    if model_path is None:
-        return _executor.submit(lambda: None)
 
-    def _load() -> YOLO:
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        log_step("Loading YOLO model")
-        return YOLO(str(model_path)).to(device)
-
-    fut = _executor.submit(_load)
-    _futures["yolo"] = fut
-    return fut
+    return registry.preload("yolo", model_path)
 
 
 def preload_tagger(device: torch.device) -> Future[Any]:
     """Start loading the WD14 ONNX tagger in the background."""
 
-    fut = _executor.submit(_load_tagger, device)
-    _futures["tagger"] = fut
-    return fut
+    return registry.preload("tagger", device)
 
 
-def preload_realesrgan(device: torch.device, scale: int) -> Future[Any]:
-    """Start loading RealESRGAN weights in the background."""
+def preload_realesrgan(
+    device: torch.device, scale: int, backend: str | None = None, threads: int | None = None
+) -> Future[Any]:
+    """Start loading RealESRGAN weights for ``backend`` in the background."""
 
-    fut = _executor.submit(_load_model, device, scale)
-    _futures["realesrgan"] = fut
-    return fut
+    return registry.preload("realesrgan", device, scale, backend, threads)
 
 
 def get(name: str) -> Any:
     """Return a loaded model by name, waiting for completion if necessary."""
 
-    fut = _futures.get(name)
-    if fut is not None:
-        return fut.result()
-    return None
+    return registry.peek(name)
 
 
 def clear() -> None:
-    """Clear any stored futures."""
+    """Forget all loaded models."""
 
-    _futures.clear()
+    registry.clear()
@@ -0,0 +1,125 @@
+"""In-memory image records passed between streaming pipeline stages."""
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from pathlib import Path
+import queue
+import threading
+from typing import Any, Iterable, Iterator
+
+from PIL import Image
+
+
+@dataclass
+class ImageRecord:
+    """A decoded image travelling through the streaming pipeline.
+
+    ``name`` is the file name the image would have on disk so streamed
+    outputs keep the naming of the directory based steps. ``meta`` carries
+    per-image information such as the caption or the target sub folder.
+    """
+
+    name: str
+    image: Image.Image
+    meta: dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def stem(self) -> str:
+        return Path(self.name).stem
+
+
+def load_records(directory: Path, pattern: str = "*.png", *, recursive: bool = False) -> Iterator[ImageRecord]:
+    """Lazily decode all images in ``directory`` into :class:`ImageRecord` objects."""
+
+    paths = directory.rglob(pattern) if recursive else directory.glob(pattern)
+    for path in sorted(paths):
+        with Image.open(path) as img:
+            rgb = img.convert("RGB")
+        yield ImageRecord(path.name, rgb, {"source": str(path)})
+
+
+def count_images(directory: Path, pattern: str = "*.png", *, recursive: bool = False) -> int:
+    """Return the number of images :func:`load_records` would yield."""
+
+    paths = directory.rglob(pattern) if recursive else directory.glob(pattern)
+    return sum(1 for _ in paths)
+
+
+def save_records(records: Iterable[ImageRecord], directory: Path) -> Iterator[ImageRecord]:
+    """Write every record to ``directory`` and pass it on.
+
+    Records with a ``subdir`` entry in their metadata are written to that
+    sub folder, which is how classification groups are materialised.
+    """
+
+    directory.mkdir(parents=True, exist_ok=True)
+    for rec in records:
+        target = directory / rec.meta.get("subdir", "")
+        target.mkdir(parents=True, exist_ok=True)
+        rec.image.save(target / rec.name)
+        yield rec
+
+
+def drain(records: Iterable[ImageRecord]) -> int:
+    """Consume ``records`` and return how many were produced."""
+
+    count = 0
+    for _ in records:
+        count += 1
+    return count
+
+
+_END = object()
+
+
+def background(records: Iterable[ImageRecord], maxsize: int = 8) -> Iterator[ImageRecord]:
+    """Produce ``records`` in a worker thread and hand them over through a bounded queue.
+
+    Wrapping every stage generator with this function gives each stage its
+    own thread so model inference, hashing and decoding overlap. The queue
+    provides backpressure: a fast stage blocks once ``maxsize`` records are
+    waiting for the next one. Exceptions raised by the stage are re-raised
+    in the consuming thread.
+    """
+
+    buf: queue.Queue = queue.Queue(maxsize=max(1, maxsize))
+    stop = threading.Event()
+
+    def _put(item: Any) -> bool:
+        while not stop.is_set():
+            try:
+                buf.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce() -> None:
+        try:
+            for rec in records:
+                if not _put(rec):
+                    return
+        except BaseException as exc:  # forwarded to the consumer
+            _put(exc)
+            return
+        finally:
+            # Shut down upstream stages as well when the consumer stopped early.
+            close = getattr(records, "close", None)
+            if close is not None:
+                close()
+        _put(_END)
+
+    worker = threading.Thread(target=_produce, daemon=True)
+    worker.start()
+    try:
+        while True:
+            item = buf.get()
+            if item is _END:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        worker.join()
@@ -3,11 +3,10 @@
 
 from pathlib import Path
 import argparse
-from .pipeline_runner import Pipeline
 from .logging_utils import rotate_log
 
 
-def parse_args() -> argparse.Namespace:
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Run the dataset pipeline")
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--video", help="Input video file")
@@ -15,36 +14,157 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("output", help="Output directory for results")
     parser.add_argument("--work", default="/tmp/work", help="Working directory")
     parser.add_argument("--trigger_word", default="name")
+    parser.add_argument(
+        "--cache_dir",
+        help="Directory for the cross-job result cache (defaults to $DSK_CACHE_DIR)",
+    )
     parser.add_argument("--fps", type=int, default=1)
+    parser.add_argument(
+        "--extract_mode",
+        choices=["fps", "scene", "keyframes"],
+        default="fps",
+        help="Sample at --fps, take frames after scene cuts or only key frames",
+    )
+    parser.add_argument("--scene_threshold", type=float, default=0.3)
+    parser.add_argument("--max_per_scene", type=int, default=1)
+    parser.add_argument(
+        "--hash_index",
+        help="File with the hashes of frames kept by earlier jobs (defaults to $DSK_HASH_INDEX)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Processes for the CPU bound stages (defaults to $DSK_WORKERS or 1)",
+    )
+    parser.add_argument(
+        "--extract_segments",
+        type=int,
+        default=1,
+        help="Decode the video in this many segments with parallel ffmpeg processes",
+    )
+    parser.add_argument(
+        "--dedup_window",
+        type=int,
+        help="Only compare frames against the last N kept frames during deduplication",
+    )
+    parser.add_argument("--upscale_batch", type=int, default=4, help="Frames upscaled per batch")
+    parser.add_argument(
+        "--upscale_tile",
+        type=int,
+        default=256,
+        help="Upscale in tiles of this size to bound memory (0 disables tiling)",
+    )
+    parser.add_argument(
+        "--upscale_backend",
+        choices=["torch", "onnx"],
+        help="Run RealESRGAN with torch or an ONNX export (defaults to $DSK_UPSCALE_BACKEND or torch)",
+    )
+    parser.add_argument(
+        "--torch_threads",
+        type=int,
+        help="Intra-op threads of the upscaler (defaults to $DSK_TORCH_THREADS or the library default)",
+    )
+    parser.add_argument(
+        "--detect_max_side",
+        type=int,
+        default=640,
+        help="Detect faces on a copy shrunk to this size on the longer side (0 for full size)",
+    )
+    parser.add_argument(
+        "--qc_max_side",
+        type=int,
+        help="Reduce frames to this size on the longer side before the quality checks",
+    )
+    parser.add_argument(
+        "--crop_first",
+        action="store_true",
+        help="Crop faces on the original frames and upscale only the crops",
+    )
     parser.add_argument("--skip_deduplication", action="store_true")
     parser.add_argument("--skip_filtering", action="store_true")
     parser.add_argument("--skip_upscaling", action="store_true")
     parser.add_argument("--skip_cropping", action="store_true")
     parser.add_argument("--skip_annotation", action="store_true")
     parser.add_argument("--skip_classification", action="store_true")
-    return parser.parse_args()
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Keep intermediate images in memory instead of writing each stage to disk",
+    )
+    parser.add_argument(
+        "--pipelined",
+        action="store_true",
+        help="Run the streaming stages concurrently with bounded queues between them",
+    )
+    parser.add_argument("--queue_size", type=int, default=8)
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run from the manifests in the working directory",
+    )
+    parser.add_argument(
+        "--connect",
+        metavar="SOCKET",
+        help="Submit the job to a running dataset_pipe service instead of running it here",
+    )
+    return parser.parse_args(argv)
 
 
-def main() -> None:
-    args = parse_args()
+def run_job(args: argparse.Namespace) -> Path:
+    """Run the pipeline for parsed command line ``args`` and return the zip path."""
+    # Imported here so ``--connect`` clients do not pay for torch & co.
+    from .pipeline_runner import Pipeline
+
     job_name = Path(args.output).name
     rotate_log(job_name)
-    pipe = Pipeline(Path("."), Path(args.output), Path(args.work))
-    pipe.run(
+    pipe = Pipeline(
+        Path("."),
+        Path(args.output),
+        Path(args.work),
+        cache_dir=Path(args.cache_dir) if args.cache_dir else None,
+        hash_index=Path(args.hash_index) if args.hash_index else None,
+    )
+    return pipe.run(
         Path(args.video) if args.video else None,
         images_dir=Path(args.images) if args.images else None,
         trigger_word=args.trigger_word,
         progress_cb=None,
         fps=args.fps,
+        workers=args.workers,
+        extract_segments=args.extract_segments,
+        extract_mode=args.extract_mode,
+        scene_threshold=args.scene_threshold,
+        max_per_scene=args.max_per_scene,
+        dedup_window=args.dedup_window,
+        upscale_batch=args.upscale_batch,
+        upscale_tile=args.upscale_tile,
+        upscale_backend=args.upscale_backend,
+        torch_threads=args.torch_threads,
+        detect_max_side=args.detect_max_side or None,
+        qc_max_side=args.qc_max_side,
+        crop_first=args.crop_first,
         skip_deduplication=args.skip_deduplication,
         skip_filtering=args.skip_filtering,
         skip_upscaling=args.skip_upscaling,
         skip_cropping=args.skip_cropping,
         skip_annotation=args.skip_annotation,
         skip_classification=args.skip_classification,
+        streaming=args.streaming,
+        pipelined=args.pipelined,
+        queue_size=args.queue_size,
+        resume=args.resume,
     )
 
 
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    if args.connect:
+        from .service import submit
+
+        raise SystemExit(submit(Path(args.connect), args))
+    run_job(args)
+
+
 if __name__ == "__main__":
     main()
 
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Long-lived pipeline service that keeps models loaded between jobs.
+
+Start the service once::
+
+    python -m dataset_pipe.pipeline.service --socket /tmp/dataset_pipe.sock
+
+and submit jobs with the regular CLI plus ``--connect``::
+
+    python -m dataset_pipe.pipeline.run_pipeline --connect /tmp/dataset_pipe.sock \\
+        --video input.mp4 output_dir
+
+The client sends the parsed arguments as one JSON line. The service runs
+the job with the models held by :mod:`.preloader` and streams back the same
+lines the CLI prints in ``PROGRESS`` mode, followed by ``DONE <zip>`` or
+``ERROR <message>``. Jobs are executed one at a time.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+from pathlib import Path
+import socket
+import socketserver
+import sys
+import threading
+
+from .logging_utils import add_sink, log_step, remove_sink
+
+DEFAULT_SOCKET = Path("/tmp/dataset_pipe.sock")
+
+# Arguments holding paths, resolved by the client since the service may run
+# in another working directory.
+_PATH_ARGS = ("output", "video", "images", "work", "cache_dir", "hash_index")
+
+_job_lock = threading.Lock()
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        from .run_pipeline import run_job
+
+        request = json.loads(self.rfile.readline())
+        args = argparse.Namespace(**request)
+
+        def _send(line: str) -> None:
+            try:
+                self.wfile.write((line + "\n").encode("utf-8"))
+                self.wfile.flush()
+            except OSError:  # client went away, keep the job running
+                pass
+
+        with _job_lock:
+            add_sink(_send)
+            try:
+                zip_path = run_job(args)
+                _send(f"DONE {zip_path}")
+            except Exception as exc:
+                _send(f"ERROR {exc}")
+            finally:
+                remove_sink(_send)
+
+
+def serve(socket_path: Path = DEFAULT_SOCKET, *, warm: bool = True) -> None:
+    """Serve jobs on the Unix socket ``socket_path`` until interrupted."""
+
+    if warm:
+        import torch
+
+        from .preloader import detect_yolo_model, preload_realesrgan, preload_tagger, preload_yolo
+
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        preload_realesrgan(device, 4)
+        preload_yolo(detect_yolo_model())
+        preload_tagger(device)
+
+    socket_path.unlink(missing_ok=True)
+    with socketserver.ThreadingUnixStreamServer(str(socket_path), _JobHandler) as server:
+        log_step(f"Service listening on {socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            socket_path.unlink(missing_ok=True)
+
+
+def submit(socket_path: Path, args: argparse.Namespace) -> int:
+    """Send a job to the service and print its output. Returns an exit code."""
+
+    payload = {}
+    for key, value in vars(args).items():
+        if key == "connect":
+            continue
+        if key in _PATH_ARGS and value:
+            value = str(Path(value).resolve())
+        payload[key] = value
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(socket_path))
+        sock.sendall((json.dumps(payload) + "\n").encode("utf-8"))
+        for line in sock.makefile("r", encoding="utf-8"):
+            line = line.rstrip("\n")
+            if line.startswith("DONE "):
+                return 0
+            if line.startswith("ERROR "):
+                print(line[len("ERROR "):], file=sys.stderr, flush=True)
+                return 1
+            print(line, flush=True)
+    print("Connection to service lost", file=sys.stderr)
+    return 1
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the dataset pipeline as a service")
+    parser.add_argument("--socket", default=str(DEFAULT_SOCKET), help="Unix socket to listen on")
+    parser.add_argument("--no_warm", action="store_true", help="Do not load models at startup")
+    args = parser.parse_args()
+    serve(Path(args.socket), warm=not args.no_warm)
+
+
+if __name__ == "__main__":
+    main()
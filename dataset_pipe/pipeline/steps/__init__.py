@@ -1,4 +1,10 @@
-from . import frame_extraction, deduplication, classification, filtering, upscaling, cropping, annotation
+"""Pipeline steps.
+
+The step modules are imported on first access so a run only loads the
+dependencies of the stages it actually executes.
+"""
+
+import importlib
 
 __all__ = [
     'frame_extraction',
@@ -9,3 +15,9 @@ __all__ = [
     'cropping',
     'annotation',
 ]
+
+
+def __getattr__(name: str):
+    if name in __all__:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
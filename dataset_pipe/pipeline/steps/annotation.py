@@ -1,26 +1,43 @@
 """Automatic tagging using the WD14 tagger."""
 
+from __future__ import annotations
+
+from functools import partial
 from pathlib import Path
-from typing import List, Any
+from typing import TYPE_CHECKING, Iterable, Iterator, List, Any
 import csv
 
 from PIL import Image
-import torch
-from huggingface_hub import hf_hub_download
 import numpy as np
-import cv2
-from onnxruntime import InferenceSession
 
+from ..cache import ResultCache, image_digest
 from ..logging_utils import log_step, log_progress
+from ..manifest import StageManifest, file_hash
+from ..metrics import inference
+from ..parallel import imap
+from ..records import ImageRecord
+from ..tag_scores import TagScoreStore
+
+if TYPE_CHECKING:  # pragma: no cover - imported lazily at run time
+    import torch
+    from onnxruntime import InferenceSession
 
 
 _REPO = "SmilingWolf/wd-swinv2-tagger-v3"
 _TAGS_FILE = "selected_tags.csv"
 
 
-def _load_tagger(device: torch.device) -> tuple[InferenceSession, int, List[str]]:
+def _load_tagger(device: torch.device | None = None) -> tuple[InferenceSession, int, List[str]]:
     """Load the ONNX tagger model and tag list from the Hugging Face Hub."""
 
+    from huggingface_hub import hf_hub_download
+    from onnxruntime import InferenceSession
+
+    if device is None:
+        import torch
+
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
     log_step("Downloading tagger weights")
     model_path = hf_hub_download(_REPO, "model.onnx")
     tags_path = hf_hub_download(_REPO, _TAGS_FILE)
@@ -43,6 +60,8 @@ def _load_tagger(device: torch.device) -> tuple[InferenceSession, int, List[str]
 def _preprocess_image(img: Image.Image, image_size: int) -> np.ndarray:
     """Prepare an image for the ONNX tagger."""
 
+    import cv2
+
     img = img.convert("RGBA")
     new = Image.new("RGBA", img.size, "WHITE")
     new.paste(img, mask=img)
@@ -66,15 +85,135 @@ def _preprocess_image(img: Image.Image, image_size: int) -> np.ndarray:
     return img
 
 
+def _prepare(
+    img_path: Path | Image.Image,
+    image_size: int,
+    cache: ResultCache | None = None,
+) -> tuple[str | None, np.ndarray | None, np.ndarray | None]:
+    """Decode an image and get it ready for the tagger.
+
+    Returns ``(cache_key, cached_scores, tensor)``. On a cache hit the tensor
+    is ``None``, otherwise ``cached_scores`` is. This is the CPU heavy part
+    of tagging and can run in worker processes.
+    """
+
+    if isinstance(img_path, Image.Image):
+        img = img_path
+    else:
+        with Image.open(img_path) as opened:
+            img = opened.copy()
+
+    key = None
+    if cache is not None:
+        key = cache.key(image_digest(img), "tagger", _REPO)
+        cached = cache.get_array(key)
+        if cached is not None:
+            return key, cached, None
+    return key, None, _preprocess_image(img, image_size)
+
+
+def _infer(
+    session: InferenceSession,
+    prepared: tuple[str | None, np.ndarray | None, np.ndarray | None],
+    cache: ResultCache | None = None,
+) -> np.ndarray:
+    """Return the scores for a result of :func:`_prepare`, running the model if needed."""
+
+    key, scores, img_tensor = prepared
+    if scores is not None:
+        return scores
+    input_name = session.get_inputs()[0].name
+    label_name = session.get_outputs()[0].name
+    with inference():
+        scores = session.run([label_name], {input_name: img_tensor})[0][0]
+    if key is not None and cache is not None:
+        cache.put_array(key, scores)
+    return scores
+
+
+def _tag_scores(
+    session: InferenceSession,
+    image_size: int,
+    img_path: Path | Image.Image,
+    cache: ResultCache | None = None,
+) -> np.ndarray:
+    """Return the raw WD14 output vector for an image.
+
+    The vector only depends on the pixels and the model, so it is looked up
+    in and stored to ``cache`` when given.
+    """
+
+    return _infer(session, _prepare(img_path, image_size, cache), cache)
+
+
+def _score_key(img: Path | Image.Image) -> str:
+    """Return the :class:`TagScoreStore` key of a file or decoded image."""
+
+    if isinstance(img, Image.Image):
+        return image_digest(img)
+    return file_hash(img)
+
+
+def _stored_scores(
+    session: InferenceSession,
+    image_size: int,
+    img: Path | Image.Image,
+    cache: ResultCache | None = None,
+    scores: TagScoreStore | None = None,
+) -> np.ndarray:
+    """Like :func:`_tag_scores`, but look up and record the result in ``scores``."""
+
+    if scores is None:
+        return _tag_scores(session, image_size, img, cache)
+    key = _score_key(img)
+    stored = scores.get(key)
+    if stored is None:
+        stored = _tag_scores(session, image_size, img, cache)
+        scores.put(key, stored)
+    return stored
+
+
+def _select_tags(
+    scores: np.ndarray,
+    tags: List[str],
+    *,
+    threshold: float = 0.3,
+    max_tags: int | None = None,
+    min_tags: int | None = None,
+) -> str:
+    """Turn a WD14 output vector into a comma-separated tag string.
+
+    See :func:`_tag_image` for the meaning of the parameters.
+    """
+
+    max_idx = min(len(tags), len(scores) - 4)
+    tag_scores = [
+        (tags[i], float(scores[i + 4])) for i in range(max_idx)
+    ]
+    tag_scores.sort(key=lambda x: x[1], reverse=True)
+
+    selected = [tag for tag, s in tag_scores if s > threshold]
+
+    if max_tags is not None:
+        selected = selected[:max_tags]
+
+    if min_tags is not None and len(selected) < min_tags:
+        additional = [tag for tag, _ in tag_scores if tag not in selected]
+        selected.extend(additional[: min_tags - len(selected)])
+
+    return ", ".join(selected)
+
+
 def _tag_image(
     session: InferenceSession,
     image_size: int,
-    img_path: Path,
+    img_path: Path | Image.Image,
     tags: List[str],
     *,
     threshold: float = 0.3,
     max_tags: int | None = None,
     min_tags: int | None = None,
+    cache: ResultCache | None = None,
 ) -> str:
     """Return a comma-separated tag string for an image.
 
@@ -85,7 +224,7 @@ def _tag_image(
     image_size:
         Target image size expected by the model.
     img_path:
-        Image to tag.
+        Image to tag, either a file path or an already decoded image.
     tags:
         List of tag names corresponding to the model outputs.
     threshold:
@@ -97,31 +236,21 @@ def _tag_image(
         Optional minimum number of tags to return. If there are fewer than this
         amount above ``threshold`` the highest scoring tags are added until the
         minimum is reached.
+    cache:
+        Optional result cache for the raw model scores.
     """
 
-    with Image.open(img_path) as img:
-        img_tensor = _preprocess_image(img, image_size)
-
-    input_name = session.get_inputs()[0].name
-    label_name = session.get_outputs()[0].name
-    scores = session.run([label_name], {input_name: img_tensor})[0][0]
-
-    max_idx = min(len(tags), len(scores) - 4)
-    tag_scores = [
-        (tags[i], float(scores[i + 4])) for i in range(max_idx)
-    ]
-    tag_scores.sort(key=lambda x: x[1], reverse=True)
-
-    selected = [tag for tag, s in tag_scores if s > threshold]
+    scores = _tag_scores(session, image_size, img_path, cache)
+    return _select_tags(scores, tags, threshold=threshold, max_tags=max_tags, min_tags=min_tags)
 
-    if max_tags is not None:
-        selected = selected[:max_tags]
 
-    if min_tags is not None and len(selected) < min_tags:
-        additional = [tag for tag, _ in tag_scores if tag not in selected]
-        selected.extend(additional[: min_tags - len(selected)])
+def _caption(scores: np.ndarray, tags: List[str], trigger_word: str) -> str:
+    """Return the caption line for ``scores`` starting with ``trigger_word``."""
 
-    return ", ".join(selected)
+    caption = _select_tags(scores, tags, threshold=0.3, max_tags=30, min_tags=10)
+    if caption:
+        return f"{trigger_word}, {caption}"
+    return trigger_word
 
 
 def run(
@@ -130,6 +259,10 @@ def run(
     *,
     trigger_word: str = "name",
     preloaded: tuple[InferenceSession, int, List[str]] | None = None,
+    manifest: StageManifest | None = None,
+    cache: ResultCache | None = None,
+    workers: int = 1,
+    scores: TagScoreStore | None = None,
 ) -> None:
     """Run image annotation with automatic tagging and fallback.
 
@@ -141,17 +274,26 @@ def run(
         Output directory for generated caption files.
     trigger_word:
         The first tag to prepend to every caption. Defaults to ``"name"``.
+    manifest:
+        Optional manifest used to skip images captioned by an interrupted run.
+    cache:
+        Optional result cache for the raw tagger scores.
+    workers:
+        Number of processes decoding and preprocessing images ahead of the
+        tagger.
+    scores:
+        Optional store receiving the raw scores of every image, so that
+        classification can reuse them instead of running the tagger again.
     """
 
     captions_dir.mkdir(parents=True, exist_ok=True)
     log_step("Annotation started")
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     try:
         if preloaded is not None:
             session, img_size, tags = preloaded
         else:
-            session, img_size, tags = _load_tagger(device)
+            session, img_size, tags = _load_tagger()
     except Exception as exc:  # pragma: no cover - download may fail
         log_step(f"Tagger unavailable: {exc}; using fallback captions")
         for img in sorted(cropped_dir.glob("*.png")):
@@ -162,22 +304,74 @@ def run(
 
     images = sorted(cropped_dir.glob("*.png"))
     total = len(images)
-    for idx, img in enumerate(images, 1):
-        caption = _tag_image(
-            session,
-            img_size,
-            img,
-            tags,
-            threshold=0.3,
-            max_tags=30,
-            min_tags=10,
-        )
-        if caption:
-            caption = f"{trigger_word}, {caption}"
+    if manifest is not None:
+        images = [img for img in images if not manifest.done(img)]
+    keys: dict[Path, str] = {}
+    stored: dict[Path, np.ndarray] = {}
+    if scores is not None:
+        keys = {img: _score_key(img) for img in images}
+        for img, key in keys.items():
+            hit = scores.get(key)
+            if hit is not None:
+                stored[img] = hit
+    pending = [img for img in images if img not in stored]
+    prepared = imap(partial(_prepare, image_size=img_size, cache=cache), pending, workers=workers)
+    try:
+        for idx, img in enumerate(images, total - len(images) + 1):
+            vector = stored.get(img)
+            if vector is None:
+                vector = _infer(session, next(prepared), cache)
+                if scores is not None:
+                    scores.put(keys[img], vector)
+            caption = _caption(vector, tags, trigger_word)
+            caption_file = captions_dir / f"{img.stem}.txt"
+            caption_file.write_text(caption)
+            if manifest is not None:
+                manifest.record(img, [caption_file])
+            log_progress("Annotation", idx, total)
+    finally:
+        if scores is not None:
+            scores.save()
+
+    log_step("Annotation completed")
+
+
+def stream(
+    records: Iterable[ImageRecord],
+    captions_dir: Path,
+    *,
+    trigger_word: str = "name",
+    preloaded: tuple[InferenceSession, int, List[str]] | None = None,
+    cache: ResultCache | None = None,
+    total: int | None = None,
+) -> Iterator[ImageRecord]:
+    """Write captions for streamed records and pass them on.
+
+    The caption is also stored as ``rec.meta["caption"]`` and the raw tagger
+    scores as ``rec.meta["tag_scores"]`` for the classification step.
+    """
+
+    captions_dir.mkdir(parents=True, exist_ok=True)
+    log_step("Annotation started")
+
+    try:
+        if preloaded is not None:
+            session, img_size, tags = preloaded
+        else:
+            session, img_size, tags = _load_tagger()
+    except Exception as exc:  # pragma: no cover - download may fail
+        log_step(f"Tagger unavailable: {exc}; using fallback captions")
+        session = None
+
+    for idx, rec in enumerate(records, 1):
+        if session is None:
+            caption = f"{trigger_word}, anime_style"
         else:
-            caption = trigger_word
-        caption_file = captions_dir / f"{img.stem}.txt"
-        caption_file.write_text(caption)
-        log_progress("Annotation", idx, total)
+            rec.meta["tag_scores"] = _tag_scores(session, img_size, rec.image, cache)
+            caption = _caption(rec.meta["tag_scores"], tags, trigger_word)
+        (captions_dir / f"{rec.stem}.txt").write_text(caption)
+        rec.meta["caption"] = caption
+        log_progress("Annotation", idx, total or idx)
+        yield rec
 
     log_step("Annotation completed")
@@ -1,20 +1,28 @@
 """Character classification based on hair, eye and style detection."""
 
+from __future__ import annotations
+
 from pathlib import Path
-from typing import List
-from onnxruntime import InferenceSession
+from typing import TYPE_CHECKING, Iterable, Iterator, List
 import shutil
 
-import torch
 import numpy as np
 from PIL import Image
-import open_clip
-import umap
-from sklearn.cluster import KMeans
-from sklearn.metrics import silhouette_score
 
+from ..cache import ResultCache, image_digest
 from ..logging_utils import log_step, log_progress
-from .annotation import _load_tagger, _tag_image
+from ..manifest import StageManifest
+from ..metrics import inference
+from ..records import ImageRecord
+from ..transfer import link_or_copy
+from ..tag_scores import TagScoreStore
+from .annotation import _load_tagger, _select_tags, _stored_scores
+
+if TYPE_CHECKING:  # pragma: no cover - imported lazily at run time
+    from onnxruntime import InferenceSession
+
+_CLIP_MODEL = "ViT-B-32"
+_CLIP_WEIGHTS = "laion2b_s34b_b79k"
 
 HAIR_COLORS = [
     "blonde hair",
@@ -89,31 +97,57 @@ def _detect_attributes(tag_str: str) -> tuple[str, str, str, str]:
     return hair, eyes, length, accessory
 
 
-def _cluster_unknowns(unclassified_dir: Path, *, n_clusters: int | None = None) -> None:
-    """Cluster images in ``unclassified_dir`` using CLIP embeddings and KMeans.
+def _cluster_labels(
+    images: List[Path | Image.Image],
+    *,
+    n_clusters: int | None = None,
+    cache: ResultCache | None = None,
+) -> List[int]:
+    """Cluster ``images`` (paths or decoded images) using CLIP embeddings and KMeans.
 
     If ``n_clusters`` is ``None`` an optimal value is estimated via the
-    silhouette score in the range 2..10 (or the number of images).
+    silhouette score in the range 2..10 (or the number of images). CLIP
+    embeddings are looked up in and stored to ``cache`` when given.
     """
 
-    images = sorted(unclassified_dir.glob("*.png"))
-    if not images:
-        return
+    import torch
+    import open_clip
+    import umap
+    from sklearn.cluster import KMeans
+    from sklearn.metrics import silhouette_score
 
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    model, _, preprocess = open_clip.create_model_and_transforms(
-        "ViT-B-32", pretrained="laion2b_s34b_b79k"
-    )
-    model = model.to(device)
-    model.eval()
+    model = None
 
     feats = []
-    for img_path in images:
-        with Image.open(img_path) as img:
-            img_t = preprocess(img).unsqueeze(0).to(device)
-            with torch.no_grad():
-                emb = model.encode_image(img_t)
-            feats.append(emb.cpu().numpy()[0])
+    for item in images:
+        if isinstance(item, Image.Image):
+            img = item
+        else:
+            with Image.open(item) as opened:
+                img = opened.copy()
+
+        key = None
+        if cache is not None:
+            key = cache.key(image_digest(img), "clip", f"{_CLIP_MODEL}/{_CLIP_WEIGHTS}")
+            cached = cache.get_array(key)
+            if cached is not None:
+                feats.append(cached)
+                continue
+
+        if model is None:
+            model, _, preprocess = open_clip.create_model_and_transforms(
+                _CLIP_MODEL, pretrained=_CLIP_WEIGHTS
+            )
+            model = model.to(device)
+            model.eval()
+        img_t = preprocess(img).unsqueeze(0).to(device)
+        with inference(), torch.no_grad():
+            emb = model.encode_image(img_t)
+        feat = emb.cpu().numpy()[0]
+        if key is not None:
+            cache.put_array(key, feat)
+        feats.append(feat)
 
     feats = np.stack(feats)
     reduced = umap.UMAP(n_components=5, random_state=42).fit_transform(feats)
@@ -135,7 +169,25 @@ def _cluster_unknowns(unclassified_dir: Path, *, n_clusters: int | None = None)
     elif len(feats) < n_clusters:
         n_clusters = max(1, len(feats))
 
-    labels = KMeans(n_clusters=n_clusters, random_state=42).fit_predict(reduced)
+    return list(KMeans(n_clusters=n_clusters, random_state=42).fit_predict(reduced))
+
+
+def _cluster_unknowns(
+    unclassified_dir: Path,
+    *,
+    n_clusters: int | None = None,
+    cache: ResultCache | None = None,
+) -> None:
+    """Move images in ``unclassified_dir`` into ``cluster_XX`` sub folders.
+
+    See :func:`_cluster_labels` for how the clusters are determined.
+    """
+
+    images = sorted(unclassified_dir.glob("*.png"))
+    if not images:
+        return
+
+    labels = _cluster_labels(images, n_clusters=n_clusters, cache=cache)
 
     for img_path, label in zip(images, labels):
         cluster_dir = unclassified_dir / f"cluster_{label:02d}"
@@ -143,57 +195,139 @@ def _cluster_unknowns(unclassified_dir: Path, *, n_clusters: int | None = None)
         shutil.move(img_path, cluster_dir / img_path.name)
 
 
+def _classify(
+    session: InferenceSession,
+    img_size: int,
+    img: Path | Image.Image,
+    tags: List[str],
+    cache: ResultCache | None = None,
+    scores: TagScoreStore | np.ndarray | None = None,
+) -> str:
+    """Return the trait folder name for ``img`` or ``"unclassified"``.
+
+    The tagger runs at most once. ``scores`` is either the score vector of
+    ``img`` or a store that may already hold it, e.g. from annotation.
+    """
+
+    if isinstance(scores, np.ndarray):
+        vector = scores
+    else:
+        vector = _stored_scores(session, img_size, img, cache, scores)
+    tag_str = _select_tags(vector, tags, threshold=0.20)
+    hair, eyes, length, accessory = _detect_attributes(tag_str)
+    if hair == "unknown" or eyes == "unknown":
+        tag_str = _select_tags(vector, tags, threshold=0.15)
+        hair, eyes, length, accessory = _detect_attributes(tag_str)
+    if hair == "unknown" or eyes == "unknown":
+        return "unclassified"
+    parts = [hair, eyes]
+    if length != "none":
+        parts.append(length)
+    if accessory != "none":
+        parts.append(accessory)
+    return "_".join(parts)
+
+
 def run(
     images_dir: Path,
     workdir: Path,
     *,
     preloaded: tuple[InferenceSession, int, List[str]] | None = None,
+    manifest: StageManifest | None = None,
+    cache: ResultCache | None = None,
+    scores: TagScoreStore | None = None,
 ) -> Path:
-    """Group images into folders based on detected hair, eye and style tags."""
+    """Group images into folders based on detected hair, eye and style tags.
+
+    Tagger scores are taken from ``scores`` when annotation stored them
+    there. ``cache`` is consulted for tagger scores and for CLIP embeddings
+    of unclassified images.
+    """
 
     workdir.mkdir(parents=True, exist_ok=True)
     log_step("Classification started")
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     try:
         if preloaded is not None:
             session, img_size, tags = preloaded
         else:
-            session, img_size, tags = _load_tagger(device)
+            session, img_size, tags = _load_tagger()
     except Exception as exc:  # pragma: no cover - download may fail
         log_step(f"Tagger unavailable: {exc}; putting all images in 'unclassified'")
         for img in sorted(images_dir.glob("*.png")):
             char_dir = workdir / "unclassified"
             char_dir.mkdir(exist_ok=True)
-            shutil.copy(img, char_dir / img.name)
+            link_or_copy(img, char_dir / img.name)
         log_step("Classification completed with fallback")
         return workdir
 
     images = sorted(images_dir.glob("*.png"))
     total = len(images)
     for idx, img_path in enumerate(images, 1):
-        tag_str = _tag_image(session, img_size, img_path, tags, threshold=0.20)
-        hair, eyes, length, accessory = _detect_attributes(tag_str)
-        if hair == "unknown" or eyes == "unknown":
-            tag_str = _tag_image(session, img_size, img_path, tags, threshold=0.15)
-            hair, eyes, length, accessory = _detect_attributes(tag_str)
-        if hair == "unknown" or eyes == "unknown":
-            char_dir = workdir / "unclassified"
-        else:
-            parts = [hair, eyes]
-            if length != "none":
-                parts.append(length)
-            if accessory != "none":
-                parts.append(accessory)
-            char_dir = workdir / "_".join(parts)
+        if manifest is not None and manifest.done(img_path):
+            log_progress("Classification", idx, total)
+            continue
+        char_dir = workdir / _classify(session, img_size, img_path, tags, cache, scores)
         char_dir.mkdir(exist_ok=True)
-        shutil.copy(img_path, char_dir / img_path.name)
+        link_or_copy(img_path, char_dir / img_path.name)
+        if manifest is not None:
+            manifest.record(img_path, [char_dir / img_path.name])
         log_progress("Classification", idx, total)
 
     unclassified = workdir / "unclassified"
     if unclassified.exists():
         log_step("Clustering unclassified images")
-        _cluster_unknowns(unclassified)
+        _cluster_unknowns(unclassified, cache=cache)
 
+    if scores is not None:
+        scores.save()
     log_step("Classification completed")
     return workdir
+
+
+def stream(
+    records: Iterable[ImageRecord],
+    *,
+    preloaded: tuple[InferenceSession, int, List[str]] | None = None,
+    cache: ResultCache | None = None,
+    total: int | None = None,
+) -> Iterator[ImageRecord]:
+    """Assign a trait folder to every streamed record.
+
+    The folder is stored as ``rec.meta["subdir"]``. Unclassified records are
+    held back until the input is exhausted so they can be clustered together.
+    """
+
+    log_step("Classification started")
+
+    try:
+        if preloaded is not None:
+            session, img_size, tags = preloaded
+        else:
+            session, img_size, tags = _load_tagger()
+    except Exception as exc:  # pragma: no cover - download may fail
+        log_step(f"Tagger unavailable: {exc}; putting all images in 'unclassified'")
+        for rec in records:
+            rec.meta["subdir"] = "unclassified"
+            yield rec
+        log_step("Classification completed with fallback")
+        return
+
+    unclassified: List[ImageRecord] = []
+    for idx, rec in enumerate(records, 1):
+        group = _classify(session, img_size, rec.image, tags, cache, rec.meta.pop("tag_scores", None))
+        log_progress("Classification", idx, total or idx)
+        if group == "unclassified":
+            unclassified.append(rec)
+            continue
+        rec.meta["subdir"] = group
+        yield rec
+
+    if unclassified:
+        log_step("Clustering unclassified images")
+        labels = _cluster_labels([rec.image for rec in unclassified], cache=cache)
+        for rec, label in zip(unclassified, labels):
+            rec.meta["subdir"] = f"unclassified/cluster_{label:02d}"
+            yield rec
+
+    log_step("Classification completed")
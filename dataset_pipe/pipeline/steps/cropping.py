@@ -1,19 +1,37 @@
 """Face cropping step using ``animeface``, ``mediapipe`` or a YOLOv8 model."""
 
+from __future__ import annotations
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+import json
+import os
 from pathlib import Path
+from typing import TYPE_CHECKING, Any, Iterable, Iterator
 
-import shutil
 from PIL import Image
-import animeface
-from ultralytics import YOLO
-import torch
-
-try:  # Optional dependency for better face detection
-    import mediapipe as mp  # type: ignore
-except Exception:  # pragma: no cover - library may be missing
-    mp = None  # type: ignore
 
+from ..cache import ResultCache, image_digest
 from ..logging_utils import log_step, log_progress
+from ..manifest import StageManifest
+from ..metrics import inference
+from ..parallel import imap
+from ..records import ImageRecord
+from ..transfer import link_or_copy
+
+if TYPE_CHECKING:  # pragma: no cover - imported lazily at run time
+    from ultralytics import YOLO
+
+
+def _mediapipe() -> Any:
+    """Return the optional ``mediapipe`` module, or ``None`` if it is missing."""
+
+    try:
+        import mediapipe as mp  # type: ignore
+    except Exception:  # pragma: no cover - library may be missing
+        return None
+    return mp
 
 
 def _crop_box(img: Image.Image, x: int, y: int, w: int, h: int, margin: float) -> Image.Image:
@@ -28,22 +46,26 @@ def _crop_box(img: Image.Image, x: int, y: int, w: int, h: int, margin: float) -
     return img.crop((left, top, right, bottom))
 
 
-def _crop_animeface(img: Image.Image, margin: float) -> list[Image.Image]:
-    faces = animeface.detect(img)
-    crops = []
-    for face in faces:
+Box = tuple[int, int, int, int, float]
+
+
+def _detect_animeface(img: Image.Image) -> list[Box]:
+    import animeface
+
+    boxes: list[Box] = []
+    for face in animeface.detect(img):
         box = face.face.pos
-        crops.append(_crop_box(img, box.x, box.y, box.width, box.height, margin))
-    return crops
+        boxes.append((box.x, box.y, box.width, box.height, float(getattr(face, "likelihood", 1.0))))
+    return boxes
 
 
-def _crop_mediapipe(img: Image.Image, detector: "mp.solutions.face_detection.FaceDetection", margin: float) -> list[Image.Image]:
-    """Crop faces using ``mediapipe`` if available."""
+def _detect_mediapipe(img: Image.Image, detector: Any) -> list[Box]:
+    """Detect faces using ``mediapipe`` if available."""
 
     import numpy as np
 
     results = detector.process(np.array(img))
-    crops: list[Image.Image] = []
+    boxes: list[Box] = []
     if results.detections:
         for det in results.detections:
             box = det.location_data.relative_bounding_box
@@ -51,25 +73,304 @@ def _crop_mediapipe(img: Image.Image, detector: "mp.solutions.face_detection.Fac
             y = int(box.ymin * img.height)
             w = int(box.width * img.width)
             h = int(box.height * img.height)
-            crops.append(_crop_box(img, x, y, w, h, margin))
-    return crops
+            boxes.append((x, y, w, h, float(det.score[0])))
+    return boxes
 
 
-def _crop_yolo(imgs: list[Image.Image], model: YOLO, margin: float, conf: float) -> list[list[Image.Image]]:
-    """Return crops for a batch of images using YOLOv8."""
+def _detect_yolo(imgs: list[Image.Image], model: YOLO) -> list[list[Box]]:
+    """Return face boxes for a batch of images using YOLOv8."""
 
     results = model(imgs)
-    batch_crops: list[list[Image.Image]] = []
-    for img, res in zip(imgs, results):
-        img_crops = []
+    batch_boxes: list[list[Box]] = []
+    for res in results:
+        boxes: list[Box] = []
         for box in res.boxes:
-            c = float(box.conf[0])
-            if c < conf:
-                continue
             x1, y1, x2, y2 = map(int, box.xyxy[0].tolist())
-            img_crops.append(_crop_box(img, x1, y1, x2 - x1, y2 - y1, margin))
-        batch_crops.append(img_crops)
-    return batch_crops
+            boxes.append((x1, y1, x2 - x1, y2 - y1, float(box.conf[0])))
+        batch_boxes.append(boxes)
+    return batch_boxes
+
+
+def _proxy(img: Image.Image, max_side: int | None) -> tuple[Image.Image, float, float]:
+    """Return ``img`` shrunk to at most ``max_side`` pixels and the factors back.
+
+    Multiplying proxy coordinates by the returned ``(fx, fy)`` maps them to
+    ``img``.
+    """
+
+    if not max_side or max(img.size) <= max_side:
+        return img, 1.0, 1.0
+    ratio = max_side / max(img.size)
+    size = (max(1, round(img.width * ratio)), max(1, round(img.height * ratio)))
+    proxy = img.resize(size, Image.BILINEAR, reducing_gap=2.0)
+    return proxy, img.width / size[0], img.height / size[1]
+
+
+def _proxy_id(detector_id: str, max_side: int | None) -> str:
+    """Return the id of ``detector_id`` running on proxies of ``max_side``."""
+
+    return f"{detector_id}@{max_side}" if max_side else detector_id
+
+
+def _scale_boxes(boxes: list[Box], fx: float, fy: float) -> list[Box]:
+    if fx == fy == 1.0:
+        return boxes
+    return [(round(x * fx), round(y * fy), round(w * fx), round(h * fy), c) for x, y, w, h, c in boxes]
+
+
+class DetectionIndex:
+    """Raw face detections of a job, kept in a JSON file across runs.
+
+    Boxes are stored per detector id, before the margin and confidence
+    filter, so a re-run with another ``margin`` or ``conf_threshold`` crops
+    from them without running detection again. Upscaled images are keyed by
+    the pixel digest of the frame they were upscaled from and their size,
+    because upscaling is not bit-reproducible across devices and backends.
+    Other images are keyed by the pixel digest of the image the detector saw.
+    """
+
+    def __init__(self, path: Path | None = None, entries: dict[str, dict[str, list]] | None = None) -> None:
+        self.path = path
+        self.entries: dict[str, dict[str, list]] = entries if entries is not None else {}
+        self.added: dict[str, dict[str, list]] = {}
+        if path is not None and path.exists():
+            try:
+                self.entries = json.loads(path.read_text())
+            except ValueError:  # truncated by a crash, detect again
+                log_step(f"Ignoring unreadable detection index {path}")
+
+    def get(self, detector_id: str, digest: str) -> list[Box] | None:
+        hit = self.entries.get(detector_id, {}).get(digest)
+        return [tuple(b) for b in hit] if hit is not None else None
+
+    def put(self, detector_id: str, digest: str, boxes: list[Box]) -> None:
+        compact = [[x, y, w, h, round(c, 4)] for x, y, w, h, c in boxes]
+        self.entries.setdefault(detector_id, {})[digest] = compact
+        self.added.setdefault(detector_id, {})[digest] = compact
+
+    def take_added(self) -> dict[str, dict[str, list]]:
+        """Return and forget the entries added since the last call."""
+
+        added, self.added = self.added, {}
+        return added
+
+    def merge(self, added: dict[str, dict[str, list]]) -> None:
+        for detector_id, boxes in added.items():
+            self.entries.setdefault(detector_id, {}).update(boxes)
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.entries, separators=(",", ":")))
+        tmp.replace(self.path)
+
+
+def _detect(
+    imgs: list[Image.Image],
+    method: str,
+    detector: Any,
+    detector_id: str,
+    cache: ResultCache | None = None,
+    max_side: int | None = None,
+    index: DetectionIndex | None = None,
+    sources: list[str | None] | None = None,
+) -> list[list[Box]]:
+    """Return the face boxes of every image, using ``cache`` or ``index`` where possible.
+
+    With ``max_side`` the detector runs on a copy shrunk to at most that many
+    pixels on the longer side and the boxes are mapped back to ``imgs``, so
+    the cost does not grow with the upscaling factor. ``sources`` are the
+    digests of the frames ``imgs`` were upscaled from, if any, see
+    :class:`DetectionIndex`.
+    """
+
+    detector_id = _proxy_id(detector_id, max_side)
+    boxes: list[list[Box] | None] = [None] * len(imgs)
+    keys: list[str | None] = [None] * len(imgs)
+    if cache is not None:
+        for i, img in enumerate(imgs):
+            keys[i] = cache.key(image_digest(img), "detection", detector_id)
+            hit = cache.get_json(keys[i])
+            if hit is not None:
+                boxes[i] = [tuple(b) for b in hit]
+
+    missing = [i for i, b in enumerate(boxes) if b is None]
+    proxies = {i: _proxy(imgs[i], max_side) for i in missing}
+    digests: dict[int, str] = {}
+    if index is not None:
+        for i in missing:
+            source = sources[i] if sources is not None else None
+            if source is not None:
+                digests[i] = f"{source}@{imgs[i].width}x{imgs[i].height}"
+            else:
+                # The proxy is much smaller than an upscaled frame and cheap to hash.
+                digests[i] = image_digest(proxies[i][0])
+            boxes[i] = index.get(detector_id, digests[i])
+            if boxes[i] is not None and keys[i] is not None:
+                cache.put_json(keys[i], boxes[i])
+        missing = [i for i in missing if boxes[i] is None]
+
+    if missing:
+        todo = [proxies[i][0] for i in missing]
+        with inference():
+            if method == "yolo":
+                found = _detect_yolo(todo, detector)
+            elif method == "mediapipe":
+                found = [_detect_mediapipe(img, detector) for img in todo]
+            else:
+                found = [_detect_animeface(img) for img in todo]
+        for i, img_boxes in zip(missing, found):
+            _, fx, fy = proxies[i]
+            img_boxes = _scale_boxes(img_boxes, fx, fy)
+            boxes[i] = img_boxes
+            if keys[i] is not None:
+                cache.put_json(keys[i], img_boxes)
+            if index is not None:
+                index.put(detector_id, digests[i], img_boxes)
+    return boxes  # type: ignore[return-value]
+
+
+def _crop_boxes(img: Image.Image, boxes: list[Box], margin: float, conf: float) -> list[Image.Image]:
+    """Crop every box with a confidence of at least ``conf`` from ``img``."""
+
+    return [_crop_box(img, x, y, w, h, margin) for x, y, w, h, c in boxes if c >= conf]
+
+
+def _crop_names(stem: str, name: str, count: int) -> list[str]:
+    """Return output file names for ``count`` crops of the image ``name``."""
+
+    if count > 1:
+        return [f"{stem}_{idx:02d}.png" for idx in range(count)]
+    return [name]
+
+
+def _load_detector(
+    yolo_model: Path | None,
+    yolo: YOLO | None,
+    conf_threshold: float,
+    use_mediapipe: bool | None,
+) -> tuple[str, Any, str]:
+    """Select the face detector and return ``(method, detector, detector_id)``.
+
+    ``detector_id`` identifies the detector and the settings that influence
+    its raw boxes, for use in cache keys.
+    """
+
+    if yolo is not None:
+        log_step("Cropping started with YOLOv8 (preloaded)")
+        weights = yolo_model or getattr(yolo, "ckpt_path", None) or "yolo"
+        return "yolo", yolo, f"yolo:{Path(str(weights)).name}"
+    if yolo_model is not None:
+        import torch
+        from ultralytics import YOLO
+
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        log_step("Cropping started with YOLOv8")
+        return "yolo", YOLO(str(yolo_model)).to(device), f"yolo:{yolo_model.name}"
+    mp = _mediapipe() if use_mediapipe is not False else None
+    if mp is not None:
+        log_step("Cropping started with mediapipe")
+        detector = mp.solutions.face_detection.FaceDetection(min_detection_confidence=conf_threshold)
+        return "mediapipe", detector, f"mediapipe:{conf_threshold}"
+    log_step("Cropping started with animeface")
+    return "animeface", None, "animeface"
+
+
+def _save_crops(path: Path, crops: list[Image.Image], workdir: Path) -> list[Path]:
+    """Write the crops of ``path`` to ``workdir``, or the image itself if there are none."""
+
+    if not crops:
+        link_or_copy(path, workdir / path.name)
+        return [workdir / path.name]
+    outputs = [workdir / name for name in _crop_names(path.stem, path.name, len(crops))]
+    for out_path, cropped in zip(outputs, crops):
+        # A resumed run may find a link to the input here; never write through it.
+        out_path.unlink(missing_ok=True)
+        cropped.save(out_path)
+    return outputs
+
+
+def _crop_file(
+    path: Path,
+    *,
+    workdir: Path,
+    margin: float,
+    min_conf: float,
+    method: str,
+    detector: Any,
+    detector_id: str,
+    cache: ResultCache | None,
+    max_side: int | None = None,
+    index: DetectionIndex | None = None,
+    source: str | None = None,
+) -> list[Path]:
+    """Detect and crop faces in a single file and return the written paths."""
+
+    with Image.open(path).convert("RGB") as img:
+        boxes = _detect([img], method, detector, detector_id, cache, max_side, index, [source])[0]
+        return _save_crops(path, _crop_boxes(img, boxes, margin, min_conf), workdir)
+
+
+_worker_detector: Any = None
+_worker_index: DetectionIndex | None = None
+
+
+def _init_worker(method: str, conf_threshold: float, known: dict[str, dict[str, list]] | None = None) -> None:
+    """Create the per-process detector used by :func:`_crop_file_in_worker`.
+
+    ``known`` are the detection index entries of the current detector.
+    """
+
+    global _worker_detector, _worker_index
+    if method == "mediapipe":
+        _worker_detector = _mediapipe().solutions.face_detection.FaceDetection(min_detection_confidence=conf_threshold)
+    _worker_index = DetectionIndex(entries=known) if known is not None else None
+
+
+def _crop_file_in_worker(
+    item: tuple[Path, str | None], **kwargs: Any
+) -> tuple[list[Path], dict[str, dict[str, list]]]:
+    """Crop the ``(path, source)`` item and return the outputs with the new detection index entries."""
+
+    path, source = item
+    outputs = _crop_file(path, detector=_worker_detector, index=_worker_index, source=source, **kwargs)
+    return outputs, _worker_index.take_added() if _worker_index is not None else {}
+
+
+def _open_rgb(path: Path) -> Image.Image:
+    with Image.open(path) as img:
+        return img.convert("RGB")
+
+
+def _prefetch(
+    paths: list[Path], batch_size: int, ahead: int, pool: ThreadPoolExecutor
+) -> Iterator[tuple[list[Path], list[Image.Image]]]:
+    """Yield batches of decoded images while ``pool`` decodes the next ``ahead`` batches."""
+
+    pending: deque[tuple[list[Path], list[Future[Image.Image]]]] = deque()
+    for i in range(0, len(paths), batch_size):
+        batch = paths[i : i + batch_size]
+        pending.append((batch, [pool.submit(_open_rgb, p) for p in batch]))
+        if len(pending) > ahead:
+            batch, futures = pending.popleft()
+            yield batch, [f.result() for f in futures]
+    while pending:
+        batch, futures = pending.popleft()
+        yield batch, [f.result() for f in futures]
+
+
+def _batched(records: Iterable[ImageRecord], size: int) -> Iterator[list[ImageRecord]]:
+    """Group ``records`` into lists of at most ``size`` items."""
+
+    batch: list[ImageRecord] = []
+    for rec in records:
+        batch.append(rec)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 def run(
@@ -82,13 +383,21 @@ def run(
     conf_threshold: float = 0.5,
     batch_size: int = 4,
     use_mediapipe: bool | None = None,
+    manifest: StageManifest | None = None,
+    cache: ResultCache | None = None,
+    workers: int = 1,
+    detect_max_side: int | None = None,
+    prefetch: int = 2,
+    save_threads: int = 2,
+    index: DetectionIndex | None = None,
+    sources: dict[str, str] | None = None,
 ) -> Path:
     """Crop faces from images.
 
     Parameters
     ----------
     upscaled_dir:
-        Directory with upscaled images.
+        Directory with the images, upscaled unless the pipeline crops first.
     workdir:
         Output directory for cropped results.
     margin:
@@ -98,67 +407,162 @@ def run(
         Optional path to a YOLOv8 model. If provided, YOLO detection is used.
     conf_threshold:
         Minimum confidence for YOLO detections.
+    manifest:
+        Optional manifest used to skip images cropped by an interrupted run.
+    cache:
+        Optional result cache for the raw detections. Boxes are cached
+        before the margin and confidence filter are applied.
+    workers:
+        Number of processes used for the ``animeface`` and ``mediapipe``
+        detectors. Each process creates its own detector.
+    detect_max_side:
+        Run the detector on a copy shrunk to at most this many pixels on the
+        longer side, e.g. the 640 pixel input of YOLOv8. Boxes are mapped
+        back and crops taken from the full image.
+    prefetch:
+        Number of batches decoded ahead of the YOLO detector, and of batches
+        whose crops may be waiting to be written.
+    save_threads:
+        Threads encoding and writing the YOLO crops.
+    index:
+        Detections of earlier runs, reused instead of running the detector.
+        New detections are added and the index is saved when done.
+    sources:
+        Pixel digest of the frame every image was upscaled from, by file
+        name, used as :class:`DetectionIndex` key.
     """
 
     workdir.mkdir(parents=True, exist_ok=True)
 
-    detector = None
-    if yolo is not None:
-        model = yolo
-        method = "yolo"
-        log_step("Cropping started with YOLOv8 (preloaded)")
-    elif yolo_model is not None:
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        model = YOLO(str(yolo_model)).to(device)
-        method = "yolo"
-        log_step("Cropping started with YOLOv8")
-    elif (use_mediapipe is None and mp is not None) or (use_mediapipe is True and mp is not None):
-        detector = mp.solutions.face_detection.FaceDetection(min_detection_confidence=conf_threshold)
-        model = None
-        method = "mediapipe"
-        log_step("Cropping started with mediapipe")
-    else:
-        model = None
-        method = "animeface"
-        log_step("Cropping started with animeface")
+    method, detector, detector_id = _load_detector(yolo_model, yolo, conf_threshold, use_mediapipe)
+    min_conf = conf_threshold if method == "yolo" else 0.0
 
     img_paths = sorted(upscaled_dir.glob("*.png"))
     total = len(img_paths)
-    processed = 0
+    if manifest is not None:
+        img_paths = [p for p in img_paths if not manifest.done(p)]
+    processed = total - len(img_paths)
+    sources = sources or {}
 
-    if method == "yolo":
-        for i in range(0, len(img_paths), batch_size):
-            batch_paths = img_paths[i : i + batch_size]
-            imgs = [Image.open(p).convert("RGB") for p in batch_paths]
-            batch_crops = _crop_yolo(imgs, model, margin, conf_threshold)
-            for p, img, crops in zip(batch_paths, imgs, batch_crops):
-                if not crops:
-                    shutil.copy(p, workdir / p.name)
-                else:
-                    for idx, cropped in enumerate(crops):
-                        out_name = f"{p.stem}_{idx:02d}.png" if len(crops) > 1 else p.name
-                        cropped.save(workdir / out_name)
-                img.close()
+    try:
+        if method == "yolo":
+            # Decode the next batches and encode the crops of earlier ones while
+            # the detector runs. Manifest entries and progress stay in order.
+            saving: deque[tuple[Path, Future[list[Path]]]] = deque()
+
+            def _finish(limit: int) -> None:
+                nonlocal processed
+                while len(saving) > limit:
+                    p, future = saving.popleft()
+                    outputs = future.result()
+                    if manifest is not None:
+                        manifest.record(p, outputs)
+                    processed += 1
+                    log_progress("Cropping", processed, total)
+
+            decode_threads = max(1, min(batch_size, os.cpu_count() or 1))
+            with ThreadPoolExecutor(decode_threads) as decoder, ThreadPoolExecutor(save_threads) as saver:
+                for batch_paths, imgs in _prefetch(img_paths, batch_size, prefetch, decoder):
+                    batch_sources = [sources.get(p.name) for p in batch_paths]
+                    batch_boxes = _detect(
+                        imgs, method, detector, detector_id, cache, detect_max_side, index, batch_sources
+                    )
+                    for p, img, boxes in zip(batch_paths, imgs, batch_boxes):
+                        crops = _crop_boxes(img, boxes, margin, min_conf)
+                        saving.append((p, saver.submit(_save_crops, p, crops, workdir)))
+                        img.close()
+                    _finish(prefetch * batch_size)
+                _finish(0)
+        else:
+            options = dict(
+                workdir=workdir,
+                margin=margin,
+                min_conf=min_conf,
+                method=method,
+                detector_id=detector_id,
+                cache=cache,
+                max_side=detect_max_side,
+            )
+            items = [(p, sources.get(p.name)) for p in img_paths]
+            if workers > 1:
+                known = None
+                if index is not None:
+                    index_id = _proxy_id(detector_id, detect_max_side)
+                    known = {index_id: index.entries.get(index_id, {})}
+                results = imap(
+                    partial(_crop_file_in_worker, **options),
+                    items,
+                    workers=workers,
+                    initializer=_init_worker,
+                    initargs=(method, conf_threshold, known),
+                )
+            else:
+                results = (
+                    (_crop_file(p, detector=detector, index=index, source=source, **options), {})
+                    for p, source in items
+                )
+            for p, (outputs, added) in zip(img_paths, results):
+                if index is not None:
+                    index.merge(added)
+                if manifest is not None:
+                    manifest.record(p, outputs)
                 processed += 1
                 log_progress("Cropping", processed, total)
-    else:
-        for p in img_paths:
-            with Image.open(p).convert("RGB") as img:
-                if method == "mediapipe" and detector is not None:
-                    crops = _crop_mediapipe(img, detector, margin)
-                else:
-                    crops = _crop_animeface(img, margin)
-
-                if not crops:
-                    shutil.copy(p, workdir / p.name)
-                    continue
-                for idx, cropped in enumerate(crops):
-                    out_name = f"{p.stem}_{idx:02d}.png" if len(crops) > 1 else p.name
-                    cropped.save(workdir / out_name)
-            processed += 1
-            log_progress("Cropping", processed, total)
-    if detector is not None:
-        detector.close()
+    finally:
+        if index is not None:
+            index.save()
+        if method == "mediapipe":
+            detector.close()
 
     log_step("Cropping completed")
     return workdir
+
+
+def stream(
+    records: Iterable[ImageRecord],
+    *,
+    margin: float = 0.3,
+    yolo_model: Path | None = None,
+    yolo: YOLO | None = None,
+    conf_threshold: float = 0.5,
+    batch_size: int = 4,
+    use_mediapipe: bool | None = None,
+    cache: ResultCache | None = None,
+    detect_max_side: int | None = None,
+    index: DetectionIndex | None = None,
+    total: int | None = None,
+) -> Iterator[ImageRecord]:
+    """Crop faces from streamed records.
+
+    Every detected face becomes its own record, named like the files written
+    by :func:`run`. Records without a detection are passed on unchanged.
+    ``index`` is used and saved like in :func:`run`.
+    """
+
+    method, detector, detector_id = _load_detector(yolo_model, yolo, conf_threshold, use_mediapipe)
+    min_conf = conf_threshold if method == "yolo" else 0.0
+
+    def _emit(rec: ImageRecord, crops: list[Image.Image]) -> Iterator[ImageRecord]:
+        if not crops:
+            yield rec
+            return
+        for out_name, cropped in zip(_crop_names(rec.stem, rec.name, len(crops)), crops):
+            yield ImageRecord(out_name, cropped, dict(rec.meta))
+
+    processed = 0
+    try:
+        for batch in _batched(records, batch_size if method == "yolo" else 1):
+            imgs = [r.image for r in batch]
+            batch_sources = [r.meta.get("source_digest") for r in batch]
+            batch_boxes = _detect(imgs, method, detector, detector_id, cache, detect_max_side, index, batch_sources)
+            for rec, boxes in zip(batch, batch_boxes):
+                processed += 1
+                log_progress("Cropping", processed, total or processed)
+                yield from _emit(rec, _crop_boxes(rec.image, boxes, margin, min_conf))
+    finally:
+        if index is not None:
+            index.save()
+        if method == "mediapipe":
+            detector.close()
+
+    log_step("Cropping completed")
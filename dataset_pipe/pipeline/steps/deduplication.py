@@ -1,16 +1,135 @@
 """Frame deduplication step using perceptual hashing."""
 
 from pathlib import Path
-import shutil
-from typing import List
+from typing import Dict, Iterable, Iterator, List
 
+import numpy as np
 from PIL import Image
-import imagehash
 
 from ..logging_utils import log_step, log_progress
+from ..manifest import StageManifest
+from ..parallel import imap
+from ..records import ImageRecord
+from ..transfer import link_or_copy
 
 
-def run(frames_dir: Path, workdir: Path, threshold: int = 8) -> Path:
+if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+
+    def _popcount(values: np.ndarray) -> np.ndarray:
+        return np.bitwise_count(values)
+
+else:
+    _POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(values: np.ndarray) -> np.ndarray:
+        bytes_ = _POPCOUNT8[values.view(np.uint8)]
+        return bytes_.reshape(values.shape + (8,)).sum(axis=-1, dtype=np.uint16)
+
+
+class _HashIndex:
+    """Kept 64 bit perceptual hashes packed into a ``uint64`` array.
+
+    A lookup XORs the query with all kept hashes at once and counts the set
+    bits, which replaces the per-hash Python ``ImageHash`` subtraction.
+    ``window`` limits lookups to the most recently kept hashes. ``seen``
+    holds hashes of earlier jobs which are always searched in full.
+    """
+
+    def __init__(self, window: int | None = None, seen: np.ndarray | None = None) -> None:
+        self.window = window
+        self.seen = seen
+        self._hashes = np.empty(1024, dtype=np.uint64)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, phash: str) -> None:
+        if self._size == len(self._hashes):
+            self._hashes = np.concatenate([self._hashes, np.empty_like(self._hashes)])
+        self._hashes[self._size] = int(phash, 16)
+        self._size += 1
+
+    def contains(self, phash: str, threshold: int) -> bool:
+        """Return ``True`` if ``phash`` is within ``threshold`` of a kept hash."""
+
+        query = np.uint64(int(phash, 16))
+        start = 0 if self.window is None else max(0, self._size - self.window)
+        for kept in (self._hashes[start:self._size], self.seen):
+            if kept is not None and len(kept) and (_popcount(kept ^ query) <= threshold).any():
+                return True
+        return False
+
+
+# ``imagehash.phash`` defaults: an 8x8 hash from the DCT of a 32x32 image.
+_HASH_SIZE = 8
+_IMG_SIZE = _HASH_SIZE * 4
+
+
+def _phash_pixels(img: Image.Image) -> np.ndarray:
+    """Return the grayscale ``32x32`` input of ``imagehash.phash`` for ``img``.
+
+    The image is decoded at full size and resized exactly like imagehash
+    does. Reducing while decoding (``draft``/``reduce``) would be faster but
+    changes the pixels and therefore the hashes.
+    """
+
+    return np.asarray(img.convert("L").resize((_IMG_SIZE, _IMG_SIZE), Image.LANCZOS))
+
+
+def _load_pixels(path: Path) -> np.ndarray:
+    with Image.open(path) as img:
+        return _phash_pixels(img)
+
+
+def phash_batch(pixels: np.ndarray) -> List[str]:
+    """Return the hex perceptual hashes of a ``(n, 32, 32)`` stack of pixels.
+
+    Computes the DCT, median and bit packing of a whole batch at once. The
+    result is identical to ``str(imagehash.phash(img))`` for every image,
+    which ``python -m dataset_pipe.benchmarks phash`` verifies.
+    """
+
+    import scipy.fftpack
+
+    dct = scipy.fftpack.dct(scipy.fftpack.dct(pixels, axis=1), axis=2)
+    low = dct[:, :_HASH_SIZE, :_HASH_SIZE].reshape(len(pixels), -1)
+    bits = low > np.median(low, axis=1, keepdims=True)
+    # Row major with the first bit as most significant, like ImageHash.__str__.
+    return [row.tobytes().hex() for row in np.packbits(bits, axis=1)]
+
+
+def _batched(items: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _hash_files(paths: List[Path], workers: int, batch_size: int) -> Iterator[str]:
+    """Yield the hex perceptual hash of every file in ``paths`` in order."""
+
+    pixels = imap(_load_pixels, paths, workers=workers)
+    for batch in _batched(pixels, batch_size):
+        yield from phash_batch(np.stack(batch))
+
+
+def run(
+    frames_dir: Path,
+    workdir: Path,
+    threshold: int = 8,
+    *,
+    manifest: StageManifest | None = None,
+    workers: int = 1,
+    window: int | None = None,
+    batch_size: int = 64,
+    seen: np.ndarray | None = None,
+    kept: Dict[str, str] | None = None,
+) -> Path:
     """Remove near-duplicate frames using perceptual hash.
 
     Parameters
@@ -22,22 +141,92 @@ def run(frames_dir: Path, workdir: Path, threshold: int = 8) -> Path:
     threshold:
         Maximum Hamming distance between perceptual hashes to consider frames
         duplicates. Lower values remove more images.
+    manifest:
+        Optional manifest used to skip frames handled by an interrupted run.
+    workers:
+        Number of processes used to compute the hashes. Frames are still
+        compared in order so the first of a group of duplicates is kept.
+    window:
+        Only compare against the last ``window`` kept frames. Useful for
+        video input where duplicates are close in time.
+    batch_size:
+        Number of images whose hashes are computed together.
+    seen:
+        Hashes of the frames kept by earlier jobs, as returned by
+        ``PersistentHashIndex.load``. Frames close to one of them are dropped. The caller adds the frames
+        that reach the final dataset to the index.
+    kept:
+        Filled with the file name and hash of every kept frame.
     """
 
     workdir.mkdir(parents=True, exist_ok=True)
     log_step("Deduplication started")
 
-    hashes: List[imagehash.ImageHash] = []
+    index = _HashIndex(window, seen)
     frames = sorted(frames_dir.glob("*.png"))
     total = len(frames)
+    entries = {}
+    if manifest is not None:
+        entries = {frame: manifest.entry(frame) for frame in frames}
+    pending = [frame for frame in frames if entries.get(frame) is None]
+    computed = _hash_files(pending, workers, batch_size)
     for idx, frame in enumerate(frames, 1):
-        with Image.open(frame) as img:
-            phash = imagehash.phash(img)
+        entry = entries.get(frame)
+        if entry is not None:
+            if entry["outputs"]:
+                index.add(entry["phash"])
+                if kept is not None:
+                    kept[frame.name] = entry["phash"]
+            log_progress("Deduplication", idx, total)
+            continue
+
+        phash = next(computed)
 
-        if all(phash - h > threshold for h in hashes):
-            hashes.append(phash)
-            shutil.copy(frame, workdir / frame.name)
+        outputs = []
+        if not index.contains(phash, threshold):
+            index.add(phash)
+            if kept is not None:
+                kept[frame.name] = phash
+            link_or_copy(frame, workdir / frame.name)
+            outputs.append(workdir / frame.name)
+        if manifest is not None:
+            manifest.record(frame, outputs, phash=phash)
         log_progress("Deduplication", idx, total)
 
     log_step("Deduplication completed")
     return workdir
+
+
+def stream(
+    records: Iterable[ImageRecord],
+    threshold: int = 8,
+    *,
+    window: int | None = None,
+    batch_size: int = 16,
+    seen: np.ndarray | None = None,
+    kept: Dict[str, str] | None = None,
+    total: int | None = None,
+) -> Iterator[ImageRecord]:
+    """Yield only the records that are not near-duplicates of an earlier one.
+
+    This is the in-memory counterpart of :func:`run` used by the streaming
+    pipeline. Records are hashed ``batch_size`` at a time, so up to that many
+    are held back before the kept ones are yielded. ``seen`` and ``kept`` are
+    used as in :func:`run`. ``total`` is only used for progress reporting.
+    """
+
+    log_step("Deduplication started")
+    index = _HashIndex(window, seen)
+    idx = 0
+    for batch in _batched(records, batch_size):
+        hashes = phash_batch(np.stack([_phash_pixels(rec.image) for rec in batch]))
+        for rec, phash in zip(batch, hashes):
+            idx += 1
+            keep = not index.contains(phash, threshold)
+            log_progress("Deduplication", idx, total or idx)
+            if keep:
+                index.add(phash)
+                if kept is not None:
+                    kept[rec.name] = phash
+                yield rec
+    log_step("Deduplication completed")
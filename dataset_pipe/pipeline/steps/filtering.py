@@ -1,17 +1,130 @@
+"""Quality filtering of frames by sharpness and brightness."""
+
+from __future__ import annotations
+
+from functools import partial
+import math
 from pathlib import Path
-import shutil
+from typing import Iterable, Iterator, List
+
+import numpy as np
+from PIL import Image
+
 from ..logging_utils import log_step, log_progress
+from ..manifest import StageManifest
+from ..parallel import imap
+from ..records import ImageRecord
+from ..transfer import link_or_copy
+
+
+def _scores(img: Image.Image, max_side: int | None = None) -> tuple[float, float]:
+    """Return the Laplacian variance and mean brightness of ``img``.
+
+    Both are computed on the grayscale image, box-reduced first so its longer
+    side is at most ``max_side`` when given. Reducing is much cheaper but
+    raises the variance of soft images, so thresholds may need adjusting.
+    """
+
+    import cv2
+
+    gray = img.convert('L')
+    if max_side:
+        factor = math.ceil(max(gray.size) / max_side)
+        if factor > 1:
+            gray = gray.reduce(factor)
+    pixels = np.asarray(gray)
+    return float(cv2.Laplacian(pixels, cv2.CV_64F).var()), float(pixels.mean())
+
 
+def _is_acceptable(scores: tuple[float, float], blur_thresh: float, dark_thresh: float) -> bool:
+    """Return ``True`` if the ``(variance, brightness)`` scores pass the checks."""
 
-def run(classified_dir: Path, workdir: Path) -> Path:
-    """Placeholder filtering step."""
+    variance, brightness = scores
+    return variance >= blur_thresh and brightness >= dark_thresh
+
+
+def _score_files(paths: List[Path], max_side: int | None = None) -> List[tuple[float, float]]:
+    """Return the :func:`_scores` of a batch of image files."""
+
+    scores = []
+    for path in paths:
+        with Image.open(path) as img:
+            scores.append(_scores(img, max_side))
+    return scores
+
+
+def run(
+    classified_dir: Path,
+    workdir: Path,
+    *,
+    blur_threshold: float = 100.0,
+    dark_threshold: float = 40.0,
+    max_side: int | None = None,
+    manifest: StageManifest | None = None,
+    workers: int = 1,
+    batch_size: int = 32,
+) -> Path:
+    """Drop blurry and dark frames and flatten the directory structure.
+
+    Parameters
+    ----------
+    classified_dir: Path
+        Directory with the input images, searched recursively.
+    workdir: Path
+        Directory receiving the accepted images.
+    blur_threshold: float, optional
+        Minimum Laplacian variance to keep a frame.
+    dark_threshold: float, optional
+        Minimum mean brightness (0-255) to keep a frame.
+    max_side: int, optional
+        Reduce images to at most this many pixels on the longer side before
+        scoring. ``None`` scores the full resolution.
+    manifest: StageManifest, optional
+        Records the scores of every image, including rejected ones.
+    workers: int, optional
+        Number of processes scoring batches of ``batch_size`` images.
+    """
     workdir.mkdir(parents=True, exist_ok=True)
     log_step('Filtering started')
     images = sorted(classified_dir.rglob('*.png'))
     total = len(images)
-    for idx, img in enumerate(images, 1):
-        # flatten the directory structure for downstream steps
-        shutil.copy(img, workdir / img.name)
+    if manifest is not None:
+        images = [img for img in images if not manifest.done(img)]
+    batches = [images[i:i + batch_size] for i in range(0, len(images), batch_size)]
+    scored = imap(partial(_score_files, max_side=max_side), batches, workers=workers)
+    scores = (s for batch in scored for s in batch)
+    rejected = 0
+    for idx, (img, score) in enumerate(zip(images, scores), total - len(images) + 1):
+        outputs = []
+        if _is_acceptable(score, blur_threshold, dark_threshold):
+            # flatten the directory structure for downstream steps
+            link_or_copy(img, workdir / img.name)
+            outputs.append(workdir / img.name)
+        else:
+            rejected += 1
+        if manifest is not None:
+            manifest.record(img, outputs, blur=score[0], brightness=score[1])
         log_progress('Filtering', idx, total)
-    log_step('Filtering completed')
+    log_step(f'Filtering completed ({rejected} rejected)')
     return workdir
+
+
+def stream(
+    records: Iterable[ImageRecord],
+    *,
+    blur_threshold: float = 100.0,
+    dark_threshold: float = 40.0,
+    max_side: int | None = None,
+    total: int | None = None,
+) -> Iterator[ImageRecord]:
+    """Yield only the streamed records passing the checks of :func:`run`."""
+    log_step('Filtering started')
+    rejected = 0
+    for idx, rec in enumerate(records, 1):
+        keep = _is_acceptable(_scores(rec.image, max_side), blur_threshold, dark_threshold)
+        log_progress('Filtering', idx, total or idx)
+        if keep:
+            yield rec
+        else:
+            rejected += 1
+    log_step(f'Filtering completed ({rejected} rejected)')
@@ -1,15 +1,28 @@
 """Frame extraction step using ffmpeg."""
 
+from __future__ import annotations
+
+import json
+import math
 from pathlib import Path
+import re
 import shutil
 import subprocess
-from typing import Iterable
+import tempfile
+from typing import Iterable, Iterator
+
+from PIL import Image
 
 from ..logging_utils import log_step
+from ..records import ImageRecord
 
 
 SUPPORTED_EXTS: Iterable[str] = {".mp4", ".mkv", ".avi", ".mov", ".webm"}
 
+# ``fps`` samples at a fixed rate, ``scene`` takes frames after scene cuts and
+# ``keyframes`` only decodes the key frames of the video.
+MODES = ("fps", "scene", "keyframes")
+
 
 def _check_ffmpeg() -> None:
     """Ensure ffmpeg is available."""
@@ -17,7 +30,181 @@ def _check_ffmpeg() -> None:
         raise EnvironmentError("ffmpeg is not installed or not in PATH")
 
 
-def run(video: Path, workdir: Path, fps: int = 1) -> Path:
+def _check_video(video: Path, mode: str = "fps") -> None:
+    if video.suffix.lower() not in SUPPORTED_EXTS:
+        raise ValueError(f"Unsupported video format: {video.suffix}")
+    if mode not in MODES:
+        raise ValueError(f"Unknown extraction mode: {mode}")
+    _check_ffmpeg()
+
+
+def _video_filter(mode: str, fps: int, scene_threshold: float, max_per_scene: int) -> str | None:
+    """Return the ``-vf`` filter selecting the frames to extract in ``mode``.
+
+    In ``scene`` mode the first frame after every cut whose scene score
+    exceeds ``scene_threshold`` is taken, followed by up to
+    ``max_per_scene - 1`` more frames of the same scene spaced ``1/fps``
+    seconds apart. Register 0 counts the frames taken from the current scene
+    and register 1 holds the time of the last one.
+    """
+
+    if mode == "fps":
+        return f"fps={fps}"
+    if mode == "keyframes":
+        return None
+    new_scene = f"gt(scene,{scene_threshold})+eq(n,0)"
+    take_more = f"lt(ld(0),{max_per_scene})*gte(t-ld(1),{1 / fps})"
+    return f"select='if({new_scene},st(0,1);st(1,t);1,if({take_more},st(0,ld(0)+1);st(1,t);1,0))'"
+
+
+def _command(
+    video: Path,
+    mode: str,
+    fps: int,
+    scene_threshold: float,
+    max_per_scene: int,
+    *,
+    loglevel: str | None = None,
+    seek: float | None = None,
+    extra_filter: str | None = None,
+) -> list[str]:
+    """Return the ffmpeg arguments decoding the frames of ``mode``, without the output."""
+
+    cmd = ["ffmpeg", "-hide_banner"]
+    if loglevel is not None:
+        cmd += ["-v", loglevel]
+    if mode == "keyframes":
+        cmd += ["-skip_frame", "nokey"]
+    if seek is not None:
+        cmd += ["-ss", f"{seek:.6f}"]
+    cmd += ["-i", str(video)]
+    filters = [f for f in (_video_filter(mode, fps, scene_threshold, max_per_scene), extra_filter) if f]
+    if filters:
+        cmd += ["-vf", ",".join(filters)]
+    if mode != "fps":  # keep only the selected frames instead of duplicating to a fixed rate
+        cmd += ["-vsync", "vfr"]
+    return cmd
+
+
+def _probe(video: Path) -> dict:
+    """Return the ffprobe description of the first video stream and the container."""
+
+    if not shutil.which("ffprobe"):
+        raise EnvironmentError("ffprobe is not installed or not in PATH")
+    result = subprocess.run(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-select_streams",
+            "v:0",
+            "-show_entries",
+            "stream=width,height:stream_tags=rotate:stream_side_data=rotation:format=duration",
+            "-of",
+            "json",
+            str(video),
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return json.loads(result.stdout)
+
+
+def _frame_size(info: dict) -> tuple[int, int]:
+    """Return the ``(width, height)`` of decoded frames, honouring rotation metadata."""
+
+    stream = info["streams"][0]
+    width, height = int(stream["width"]), int(stream["height"])
+    rotation = stream.get("tags", {}).get("rotate")
+    for side_data in stream.get("side_data_list", []):
+        rotation = side_data.get("rotation", rotation)
+    # ffmpeg auto-rotates while decoding, portrait videos come out transposed.
+    if rotation is not None and int(float(rotation)) % 180 != 0:
+        width, height = height, width
+    return width, height
+
+
+def estimate_frames(video: Path, fps: int = 1, mode: str = "fps") -> int | None:
+    """Return roughly how many frames :func:`stream` yields, for progress reporting.
+
+    Only the ``fps`` mode has a predictable frame count, ``None`` is
+    returned for the others.
+    """
+
+    if mode != "fps":
+        return None
+    try:
+        duration = float(_probe(video)["format"]["duration"])
+    except (OSError, KeyError, ValueError, subprocess.CalledProcessError):
+        return None
+    return max(1, math.ceil(duration * fps))
+
+
+def _split(total: int, parts: int) -> list[tuple[int, int]]:
+    """Split ``total`` frames into ``parts`` contiguous ``(first, count)`` ranges."""
+
+    parts = max(1, min(parts, total))
+    bounds = [total * i // parts for i in range(parts + 1)]
+    return [(bounds[i], bounds[i + 1] - bounds[i]) for i in range(parts)]
+
+
+def _run_segments(video: Path, output_pattern: Path, fps: int, segments: int) -> None:
+    """Extract ``segments`` time ranges of ``video`` with concurrent ffmpeg processes.
+
+    Segment boundaries fall on output frame times (multiples of ``1/fps``),
+    every process seeks to its first frame and numbers its files from the
+    global index of that frame, so the result matches a single pass.
+    """
+
+    duration = float(_probe(video)["format"]["duration"])
+    ranges = _split(max(1, math.ceil(duration * fps)), segments)
+    procs = []
+    for i, (first, count) in enumerate(ranges):
+        cmd = _command(video, "fps", fps, 0.0, 1, loglevel="error", seek=first / fps)
+        if i < len(ranges) - 1:  # the last segment runs to the end of the video
+            cmd += ["-frames:v", str(count)]
+        cmd += ["-start_number", str(first + 1), str(output_pattern)]
+        procs.append(subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE))
+
+    errors = []
+    for proc in procs:
+        _, stderr = proc.communicate()
+        if proc.returncode != 0:
+            errors.append(subprocess.CalledProcessError(proc.returncode, proc.args, stderr=stderr))
+    if errors:
+        raise errors[0]
+
+
+def _parse_showinfo(log: str) -> list[float]:
+    """Return the ``pts_time`` of every frame reported by the ``showinfo`` filter."""
+
+    return [float(t) for t in re.findall(r"\bpts_time:\s*(-?[\d.]+)", log)]
+
+
+def _write_timestamps(workdir: Path, fps: int, times: list[float] | None = None) -> None:
+    """Store the video time of every extracted frame in ``timestamps.json``.
+
+    Without ``times`` the frames are assumed to be sampled at ``fps``.
+    """
+
+    frames = sorted(workdir.glob("frame_*.png"))
+    if times is None:
+        times = [(int(frame.stem.split("_")[1]) - 1) / fps for frame in frames]
+    timestamps = {frame.name: t for frame, t in zip(frames, times)}
+    (workdir / "timestamps.json").write_text(json.dumps(timestamps, indent=0))
+
+
+def run(
+    video: Path,
+    workdir: Path,
+    fps: int = 1,
+    *,
+    segments: int = 1,
+    mode: str = "fps",
+    scene_threshold: float = 0.3,
+    max_per_scene: int = 1,
+) -> Path:
     """Extract frames from the video using ffmpeg.
 
     Parameters
@@ -28,24 +215,108 @@ def run(video: Path, workdir: Path, fps: int = 1) -> Path:
         Directory where extracted frames will be stored.
     fps: int, optional
         Number of frames per second to extract. Defaults to ``1``.
+    segments: int, optional
+        Split the video into this many time segments and decode them with
+        concurrent ffmpeg processes. Frame names and the timestamps written
+        to ``timestamps.json`` are the same as for a single pass. Only
+        supported in ``fps`` mode.
+    mode: str, optional
+        One of :data:`MODES`. Defaults to ``"fps"``.
+    scene_threshold: float, optional
+        Minimum ffmpeg scene score (0-1) that starts a new scene in
+        ``scene`` mode.
+    max_per_scene: int, optional
+        Maximum number of frames taken from one scene in ``scene`` mode,
+        spaced ``1/fps`` seconds apart.
     """
-    if video.suffix.lower() not in SUPPORTED_EXTS:
-        raise ValueError(f"Unsupported video format: {video.suffix}")
-
-    _check_ffmpeg()
+    _check_video(video, mode)
+    if segments > 1 and mode != "fps":
+        raise ValueError("segmented extraction is only supported in fps mode")
 
     workdir.mkdir(parents=True, exist_ok=True)
     output_pattern = workdir / "frame_%04d.png"
     log_step("Frame Extraction started")
+    times = None
     try:
-        subprocess.run(
-            ["ffmpeg", "-i", str(video), "-vf", f"fps={fps}", str(output_pattern)],
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
+        if segments > 1:
+            _run_segments(video, output_pattern, fps, segments)
+        else:
+            # ``showinfo`` reports the time of frames that are not evenly spaced.
+            extra_filter = "showinfo" if mode != "fps" else None
+            cmd = _command(video, mode, fps, scene_threshold, max_per_scene, extra_filter=extra_filter)
+            result = subprocess.run(
+                cmd + [str(output_pattern)],
+                check=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            if extra_filter:
+                times = _parse_showinfo(result.stderr.decode("utf-8", "replace"))
     except subprocess.CalledProcessError as e:
         log_step(f"Frame extraction failed: {e}")
         raise
+    _write_timestamps(workdir, fps, times)
     log_step("Frame Extraction completed")
     return workdir
+
+
+def stream(
+    video: Path,
+    fps: int = 1,
+    *,
+    mode: str = "fps",
+    scene_threshold: float = 0.3,
+    max_per_scene: int = 1,
+) -> Iterator[ImageRecord]:
+    """Decode frames from ``video`` through an ffmpeg pipe without touching disk.
+
+    ffmpeg writes raw RGB frames to its stdout which are read one frame at a
+    time, so at most one decoded frame is buffered here. Records are named
+    like the files written by :func:`run` (``frame_0001.png`` ...).
+
+    Parameters
+    ----------
+    video: Path
+        Path to the input video file.
+    fps: int, optional
+        Number of frames per second to extract. Defaults to ``1``.
+    mode, scene_threshold, max_per_scene:
+        Frame selection, see :func:`run`.
+    """
+    _check_video(video, mode)
+    width, height = _frame_size(_probe(video))
+    frame_bytes = width * height * 3
+
+    log_step("Frame Extraction started")
+    with tempfile.TemporaryFile() as errors:
+        cmd = _command(video, mode, fps, scene_threshold, max_per_scene, loglevel="error")
+        proc = subprocess.Popen(
+            cmd + ["-f", "rawvideo", "-pix_fmt", "rgb24", "pipe:1"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=errors,
+            bufsize=frame_bytes,
+        )
+        idx = 0
+        try:
+            while True:
+                buf = proc.stdout.read(frame_bytes)
+                if len(buf) < frame_bytes:
+                    break
+                idx += 1
+                img = Image.frombytes("RGB", (width, height), buf)
+                meta = {"source": str(video), "frame": idx}
+                if mode == "fps":
+                    meta["time"] = (idx - 1) / fps
+                yield ImageRecord(f"frame_{idx:04d}.png", img, meta)
+            proc.stdout.close()
+            if proc.wait() != 0:
+                errors.seek(0)
+                message = errors.read().decode("utf-8", "replace").strip()
+                log_step(f"Frame extraction failed: {message}")
+                raise subprocess.CalledProcessError(proc.returncode, proc.args, stderr=message)
+        finally:
+            if proc.poll() is None:  # consumer stopped early
+                proc.kill()
+                proc.wait()
+    log_step(f"Frame Extraction completed ({idx} frames)")
@@ -1,41 +1,85 @@
-"""Automatic upscaling and quality checking."""
+"""Automatic upscaling with RealESRGAN."""
 
+from __future__ import annotations
+
+import os
 from pathlib import Path
-from typing import Optional
+import time
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Iterator, List, Optional, TypeVar
 
 import numpy as np
 from PIL import Image
-import torch
-import cv2
 
+from ..cache import ResultCache, image_digest
 from ..logging_utils import log_step, log_progress
+from ..manifest import StageManifest
+from ..metrics import inference, rss_bytes
+from ..records import ImageRecord
 
+if TYPE_CHECKING:  # pragma: no cover - imported lazily at run time
+    import torch
 
-try:  # Optional dependency
-    try:
-        from torchvision.transforms.functional_tensor import rgb_to_grayscale  # type: ignore
-    except Exception:  # pragma: no cover - new torchvision versions
-        from torchvision.transforms.functional import rgb_to_grayscale
-        import types, sys
+T = TypeVar("T")
 
-        shim = types.ModuleType("torchvision.transforms.functional_tensor")
-        shim.rgb_to_grayscale = rgb_to_grayscale
-        sys.modules["torchvision.transforms.functional_tensor"] = shim
+# Seconds between two throughput reports.
+_REPORT_INTERVAL = 10.0
 
-    try:
-        from realesrgan import RealESRGAN  # old API
-    except Exception:  # pragma: no cover - fallback to new API
-        from realesrgan.utils import RealESRGANer as RealESRGAN
-except Exception:  # pragma: no cover - library may not be installed
-    RealESRGAN = None  # type: ignore[misc]
+# Where ONNX exports of the upscaler are cached.
+_ONNX_DIR = Path("models")
+
+
+def _import_realesrgan() -> Optional[type]:
+    """Return the RealESRGAN model class, or ``None`` if it is not installed."""
+
+    try:  # Optional dependency
+        try:
+            from torchvision.transforms.functional_tensor import rgb_to_grayscale  # type: ignore
+        except Exception:  # pragma: no cover - new torchvision versions
+            from torchvision.transforms.functional import rgb_to_grayscale
+            import types, sys
+
+            shim = types.ModuleType("torchvision.transforms.functional_tensor")
+            shim.rgb_to_grayscale = rgb_to_grayscale
+            sys.modules["torchvision.transforms.functional_tensor"] = shim
+
+        try:
+            from realesrgan import RealESRGAN  # old API
+        except Exception:  # pragma: no cover - fallback to new API
+            from realesrgan.utils import RealESRGANer as RealESRGAN
+    except Exception:  # pragma: no cover - library may not be installed
+        return None
+    return RealESRGAN
+
+
+def _load_model(
+    device: torch.device | None, scale: int, backend: str | None = None, threads: int | None = None
+) -> Optional[object]:
+    """Load the RealESRGAN anime model for ``backend`` if available.
+
+    ``backend`` is ``"torch"`` or ``"onnx"`` and defaults to
+    ``DSK_UPSCALE_BACKEND`` or ``"torch"``. ``threads`` are the intra-op
+    threads of the ONNX session, see :func:`_set_threads`.
+    """
+
+    backend = backend or os.getenv("DSK_UPSCALE_BACKEND", "torch")
+    if backend == "onnx":
+        return _load_onnx(device, scale, threads)
+    if backend != "torch":
+        raise ValueError(f"Unknown upscaling backend: {backend}")
+    return _load_torch(device, scale)
 
 
-def _load_model(device: torch.device, scale: int) -> Optional[object]:
+def _load_torch(device: torch.device | None, scale: int) -> Optional[object]:
     """Load RealESRGAN anime model if available."""
 
+    RealESRGAN = _import_realesrgan()
     if RealESRGAN is None:
         log_step("RealESRGAN not available – using PIL resize")
         return None
+    if device is None:
+        import torch
+
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     try:
         if RealESRGAN.__name__ == "RealESRGANer":  # modernes API
             from realesrgan.archs.srvgg_arch import SRVGGNetCompact
@@ -73,57 +117,419 @@ def _load_model(device: torch.device, scale: int) -> Optional[object]:
         return None
 
 
-def _is_acceptable(img: Image.Image, blur_thresh: float, dark_thresh: float) -> bool:
-    """Return ``True`` if image passes basic quality checks."""
+def _model_id(model: object) -> str:
+    """Return the name of the weights loaded by :func:`_load_model`."""
 
-    gray = np.array(img.convert("L"))
-    variance = cv2.Laplacian(gray, cv2.CV_64F).var()
-    if variance < blur_thresh:
-        return False
-    brightness = gray.mean()
-    if brightness < dark_thresh:
+    if isinstance(model, _OnnxUpscaler) or type(model).__name__ == "RealESRGANer":
+        return "realesr-animevideov3"
+    return "RealESRGAN_x4plus_anime_6B"
+
+
+def _upscale(
+    img: Image.Image,
+    model: object | None,
+    scale: int,
+    cache: ResultCache | None = None,
+) -> Image.Image:
+    """Upscale ``img`` with RealESRGAN or fall back to a Lanczos resize.
+
+    Model results are looked up in and stored to ``cache`` when given.
+    """
+
+    if model is not None:
+        import torch
+
+        key = None
+        if cache is not None:
+            key = cache.key(image_digest(img), "upscaling", _model_id(model), scale=scale)
+            cached = cache.get_image(key)
+            if cached is not None:
+                return cached
+        with inference(), torch.no_grad():  # pragma: no cover - heavy model inference
+            upscaled, _ = model.enhance(np.array(img))
+        up_img = Image.fromarray(upscaled)
+        if key is not None:
+            cache.put_image(key, up_img)
+        return up_img
+    width, height = img.size
+    return img.resize((width * scale, height * scale), Image.LANCZOS)
+
+
+def _compact_net(model: object | None) -> Any:
+    """Return the ``SRVGGNetCompact`` wrapped by a ``RealESRGANer``, else ``None``."""
+
+    net = getattr(model, "model", None)
+    return net if type(net).__name__ == "SRVGGNetCompact" else None
+
+
+def _env_threads() -> int | None:
+    env_threads = os.getenv("DSK_TORCH_THREADS")
+    return int(env_threads) if env_threads else None
+
+
+def _set_threads(threads: int | None) -> None:
+    """Set the torch intra-op threads to ``threads`` or ``DSK_TORCH_THREADS``."""
+
+    threads = threads or _env_threads()
+    if threads:
+        import torch
+
+        torch.set_num_threads(threads)
+
+
+class _OnnxUpscaler:
+    """``SRVGGNetCompact`` exported to ONNX and run with onnxruntime."""
+
+    def __init__(self, path: Path, scale: int, *, cuda: bool = False, threads: int | None = None) -> None:
+        from onnxruntime import GraphOptimizationLevel, InferenceSession, SessionOptions
+
+        options = SessionOptions()
+        options.graph_optimization_level = GraphOptimizationLevel.ORT_ENABLE_ALL
+        # One large convolution at a time, parallelised inside the operator.
+        options.inter_op_num_threads = 1
+        if threads:
+            options.intra_op_num_threads = threads
+        providers = ["CUDAExecutionProvider", "CPUExecutionProvider"] if cuda else ["CPUExecutionProvider"]
+        self.path = path
+        self.scale = scale
+        self.session = InferenceSession(str(path), options, providers=providers)
+
+    def forward(self, x: np.ndarray) -> np.ndarray:
+        return self.session.run(None, {"input": x})[0]
+
+
+def _onnx_path(scale: int) -> Path:
+    return _ONNX_DIR / f"realesr-animevideov3-x{scale}.onnx"
+
+
+def _export_onnx(net: Any, path: Path, scale: int, tolerance: float = 1e-3) -> bool:
+    """Export ``net`` to ``path`` and check that onnxruntime reproduces it.
+
+    Returns ``False`` (and removes the export) if the outputs of both differ
+    by more than ``tolerance`` on a random input.
+    """
+
+    import torch
+
+    net = net.to("cpu").eval()
+    sample = torch.rand(1, 3, 64, 64)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".onnx.tmp")
+    axes = {0: "batch", 2: "height", 3: "width"}
+    torch.onnx.export(
+        net,
+        sample,
+        str(tmp),
+        input_names=["input"],
+        output_names=["output"],
+        dynamic_axes={"input": axes, "output": axes},
+        opset_version=17,
+    )
+    with torch.no_grad():
+        expected = net(sample).numpy()
+    actual = _OnnxUpscaler(tmp, scale).forward(sample.numpy())
+    diff = float(np.abs(actual - expected).max())
+    if diff > tolerance:
+        log_step(f"ONNX export of RealESRGAN differs by {diff:.2e}; not using it")
+        tmp.unlink()
         return False
+    tmp.replace(path)
+    log_step(f"Exported RealESRGAN to {path} (max difference {diff:.2e})")
     return True
 
 
+def _load_onnx(device: torch.device | None, scale: int, threads: int | None = None) -> Optional[object]:
+    """Load the cached ONNX export of the model, exporting it on first use.
+
+    Falls back to the torch model when the export is not possible.
+    """
+
+    path = _onnx_path(scale)
+    if not path.exists():
+        model = _load_torch(None, scale)
+        net = _compact_net(model)
+        if net is None:
+            log_step("ONNX upscaling needs the realesr-animevideov3 model; using torch")
+            return model
+        try:
+            exported = _export_onnx(net, path, scale)
+        except Exception as exc:  # pragma: no cover - exporter may be missing
+            log_step(f"ONNX export failed: {exc}; using torch")
+            exported = False
+        if not exported:
+            return _load_torch(device, scale)
+
+    if device is not None:
+        cuda = device.type == "cuda"
+    else:
+        from onnxruntime import get_available_providers
+
+        cuda = "CUDAExecutionProvider" in get_available_providers()
+    return _OnnxUpscaler(path, scale, cuda=cuda, threads=threads or _env_threads())
+
+
+def _forward(model: object | None) -> Callable[[np.ndarray], np.ndarray] | None:
+    """Return a batched forward pass over ``float32`` NCHW arrays in ``[0, 1]``.
+
+    ``None`` is returned for models that only offer ``enhance``.
+    """
+
+    if isinstance(model, _OnnxUpscaler):
+        return model.forward
+    net = _compact_net(model)
+    if net is None:
+        return None
+
+    import torch
+
+    device = next(net.parameters()).device
+
+    def forward(x: np.ndarray) -> np.ndarray:
+        with torch.no_grad():
+            return net(torch.from_numpy(x).to(device)).cpu().numpy()
+
+    return forward
+
+
+def _enhance_batch(
+    forward: Callable[[np.ndarray], np.ndarray],
+    pixels: np.ndarray,
+    scale: int,
+    tile: int,
+    overlap: int,
+) -> np.ndarray:
+    """Upscale a ``(n, h, w, 3)`` RGB ``uint8`` batch with ``forward``.
+
+    With ``tile`` the frames are processed in ``tile x tile`` regions, each
+    padded by ``overlap`` pixels of context that are cut off again, so the
+    activations never exceed those of one batch of tiles. The output is
+    assembled as ``uint8``.
+    """
+
+    n, height, width, _ = pixels.shape
+    frames = pixels.transpose(0, 3, 1, 2).astype(np.float32) / np.float32(255)
+
+    def _run(x: np.ndarray) -> np.ndarray:
+        y = forward(np.ascontiguousarray(x))
+        return (np.clip(y, 0, 1) * 255).round().astype(np.uint8)
+
+    if not tile or (height <= tile and width <= tile):
+        out = _run(frames)
+    else:
+        out = np.empty((n, 3, height * scale, width * scale), dtype=np.uint8)
+        for top in range(0, height, tile):
+            for left in range(0, width, tile):
+                bottom, right = min(top + tile, height), min(left + tile, width)
+                pad_top, pad_left = max(0, top - overlap), max(0, left - overlap)
+                pad_bottom, pad_right = min(height, bottom + overlap), min(width, right + overlap)
+                y = _run(frames[:, :, pad_top:pad_bottom, pad_left:pad_right])
+                y0, x0 = (top - pad_top) * scale, (left - pad_left) * scale
+                out[:, :, top * scale : bottom * scale, left * scale : right * scale] = y[
+                    :, :, y0 : y0 + (bottom - top) * scale, x0 : x0 + (right - left) * scale
+                ]
+    return np.ascontiguousarray(out.transpose(0, 2, 3, 1))
+
+
+def _upscale_batch(
+    imgs: List[Image.Image],
+    model: object | None,
+    scale: int,
+    cache: ResultCache | None = None,
+    *,
+    tile: int = 0,
+    overlap: int = 16,
+) -> List[Image.Image]:
+    """Upscale images of the same size in one batch where the model allows it.
+
+    ``SRVGGNetCompact`` models, in torch or ONNX, are run batched, everything
+    else goes through :func:`_upscale` image by image.
+    """
+
+    forward = _forward(model)
+    if forward is None:
+        return [_upscale(img, model, scale, cache) for img in imgs]
+
+    results: List[Image.Image | None] = [None] * len(imgs)
+    keys: List[str | None] = [None] * len(imgs)
+    if cache is not None:
+        for i, img in enumerate(imgs):
+            keys[i] = cache.key(image_digest(img), "upscaling", _model_id(model), scale=scale)
+            results[i] = cache.get_image(keys[i])
+
+    missing = [i for i, res in enumerate(results) if res is None]
+    if missing:
+        pixels = np.stack([np.asarray(imgs[i].convert("RGB")) for i in missing])
+        with inference():  # pragma: no cover - heavy model inference
+            upscaled = _enhance_batch(forward, pixels, scale, tile, overlap)
+        for i, arr in zip(missing, upscaled):
+            results[i] = Image.fromarray(arr)
+            if keys[i] is not None:
+                cache.put_image(keys[i], results[i])
+    return results  # type: ignore[return-value]
+
+
+def _size_batches(
+    items: Iterable[T],
+    size_of: Callable[[T], tuple[int, int]],
+    batch_size: int,
+    max_pixels: int,
+) -> Iterator[List[T]]:
+    """Group consecutive ``items`` of the same size into batches.
+
+    A batch holds at most ``batch_size`` items and, unless a single item is
+    larger, at most ``max_pixels`` input pixels, which bounds the memory of
+    the upscaled batch.
+    """
+
+    batch: List[T] = []
+    batch_dims = None
+    for item in items:
+        width, height = dims = size_of(item)
+        limit = max(1, min(batch_size, max_pixels // max(1, width * height)))
+        if batch and (dims != batch_dims or len(batch) >= limit):
+            yield batch
+            batch = []
+        batch.append(item)
+        batch_dims = dims
+    if batch:
+        yield batch
+
+
+class _Throughput:
+    """Log images per second and the RSS of the process every few seconds."""
+
+    def __init__(self) -> None:
+        self.start = self.last = time.perf_counter()
+        self.images = 0
+
+    def add(self, count: int, *, final: bool = False) -> None:
+        self.images += count
+        now = time.perf_counter()
+        if final or now - self.last >= _REPORT_INTERVAL:
+            self.last = now
+            rate = self.images / (now - self.start) if now > self.start else 0.0
+            log_step(f"Upscaling {rate:.2f} images/s, RSS {rss_bytes() / 1024**2:.0f} MB")
+
+
+def _image_size(path: Path) -> tuple[int, int]:
+    with Image.open(path) as img:
+        return img.size
+
+
 def run(
     filtered_dir: Path,
     workdir: Path,
     *,
     scale: int = 4,
-    blur_threshold: float = 100.0,
-    dark_threshold: float = 40.0,
     model: object | None = None,
     device: torch.device | None = None,
+    manifest: StageManifest | None = None,
+    cache: ResultCache | None = None,
+    batch_size: int = 4,
+    tile: int = 256,
+    overlap: int = 16,
+    max_batch_pixels: int = 4_000_000,
+    threads: int | None = None,
+    backend: str | None = None,
 ) -> Path:
-    """Upscale images with RealESRGAN and drop low-quality frames."""
+    """Upscale images with RealESRGAN.
+
+    Low quality frames are dropped beforehand by the filtering step.
+
+    Parameters
+    ----------
+    batch_size:
+        Number of consecutive images of the same size upscaled together by
+        ``SRVGGNetCompact`` models.
+    tile, overlap:
+        Process frames in ``tile x tile`` regions with ``overlap`` pixels of
+        context on each side. ``0`` upscales whole frames.
+    max_batch_pixels:
+        Upper bound for the input pixels of one batch, limiting peak memory
+        on large frames.
+    threads:
+        Torch intra-op threads, also used by the ONNX session when
+        ``model`` is not given. Defaults to ``DSK_TORCH_THREADS`` or the
+        torch default.
+    backend:
+        ``"torch"`` or ``"onnx"`` when ``model`` is not given, see
+        :func:`_load_model`.
+    """
 
     workdir.mkdir(parents=True, exist_ok=True)
     log_step("Upscaling started")
 
-    if device is None:
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     if model is None:
-        model = _load_model(device, scale)
+        model = _load_model(device, scale, backend, threads)
+    if model is not None and not isinstance(model, _OnnxUpscaler):
+        _set_threads(threads)
 
     images = sorted(filtered_dir.glob("*.png"))
     total = len(images)
-    for idx, img_path in enumerate(images, 1):
-        with Image.open(img_path).convert("RGB") as img:
-            if not _is_acceptable(img, blur_threshold, dark_threshold):
-                continue
-
-            if model is not None:
-                with torch.no_grad():  # pragma: no cover - heavy model inference
-                    upscaled, _ = model.enhance(np.array(img))
-                up_img = Image.fromarray(upscaled)
-            else:
-                width, height = img.size
-                up_img = img.resize((width * scale, height * scale), Image.LANCZOS)
-
+    if manifest is not None:
+        images = [p for p in images if not manifest.done(p)]
+    idx = total - len(images)
+    throughput = _Throughput()
+    for batch in _size_batches(images, _image_size, batch_size, max_batch_pixels):
+        imgs = [Image.open(p).convert("RGB") for p in batch]
+        upscaled = _upscale_batch(imgs, model, scale, cache, tile=tile, overlap=overlap)
+        for img_path, img, up_img in zip(batch, imgs, upscaled):
             out_path = workdir / img_path.name
             up_img.save(out_path)
-        log_progress("Upscaling", idx, total)
+            if manifest is not None:
+                # Identifies the output independently of the upscaler, see
+                # ``cropping.DetectionIndex``.
+                manifest.record(img_path, [out_path], source=image_digest(img))
+            img.close()
+            idx += 1
+            log_progress("Upscaling", idx, total)
+        throughput.add(len(batch))
+    throughput.add(0, final=True)
 
     log_step("Upscaling completed")
     return workdir
+
+
+def stream(
+    records: Iterable[ImageRecord],
+    *,
+    scale: int = 4,
+    model: object | None = None,
+    device: torch.device | None = None,
+    cache: ResultCache | None = None,
+    batch_size: int = 4,
+    tile: int = 256,
+    overlap: int = 16,
+    max_batch_pixels: int = 4_000_000,
+    threads: int | None = None,
+    backend: str | None = None,
+    total: int | None = None,
+) -> Iterator[ImageRecord]:
+    """Upscale streamed records, see :func:`run` for the batching options.
+
+    Only consecutive records of the same size are batched, so the order of
+    the records is kept. The digest of every input image is stored as
+    ``meta["source_digest"]``.
+    """
+
+    log_step("Upscaling started")
+
+    if model is None:
+        model = _load_model(device, scale, backend, threads)
+    if model is not None and not isinstance(model, _OnnxUpscaler):
+        _set_threads(threads)
+
+    idx = 0
+    throughput = _Throughput()
+    for batch in _size_batches(records, lambda rec: rec.image.size, batch_size, max_batch_pixels):
+        upscaled = _upscale_batch([rec.image for rec in batch], model, scale, cache, tile=tile, overlap=overlap)
+        throughput.add(len(batch))
+        for rec, up_img in zip(batch, upscaled):
+            rec.meta["source_digest"] = image_digest(rec.image)
+            rec.image = up_img
+            idx += 1
+            log_progress("Upscaling", idx, total or idx)
+            yield rec
+    throughput.add(0, final=True)
+
+    log_step("Upscaling completed")
@@ -0,0 +1,82 @@
+"""Raw tagger scores shared by the annotation and classification steps."""
+
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from .logging_utils import log_step
+
+_DTYPE = np.dtype("<f2")
+
+
+class TagScoreStore:
+    """WD14 output vectors of a job, one ``float16`` row per image.
+
+    Rows are appended to ``<prefix>.f16`` and read back through a memory
+    map. ``<prefix>.json`` maps image keys (content hashes) to rows and is
+    written by :meth:`save`. Storing the whole vector lets every step apply
+    its own thresholds without running the tagger again.
+    """
+
+    def __init__(self, prefix: Path) -> None:
+        self.matrix_path = prefix.with_suffix(".f16")
+        self.index_path = prefix.with_suffix(".json")
+        self.width: int | None = None
+        self.rows: dict[str, int] = {}
+        self._map: np.ndarray | None = None
+        if self.index_path.exists() and self.matrix_path.exists():
+            try:
+                index = json.loads(self.index_path.read_text())
+                self.width, self.rows = index["width"], index["rows"]
+            except (ValueError, KeyError):  # truncated by a crash, tag again
+                log_step(f"Ignoring unreadable tag score index {self.index_path}")
+                self.width, self.rows = None, {}
+        if not self.rows:
+            self.matrix_path.unlink(missing_ok=True)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def get(self, key: str) -> np.ndarray | None:
+        """Return the stored scores for ``key`` as ``float32`` or ``None``."""
+
+        row = self.rows.get(key)
+        if row is None:
+            return None
+        if self._map is None or row >= len(self._map):
+            # Rows appended since the file was mapped are not visible yet.
+            count = self.matrix_path.stat().st_size // (_DTYPE.itemsize * self.width)
+            self._map = np.memmap(self.matrix_path, dtype=_DTYPE, mode="r", shape=(count, self.width))
+        return self._map[row].astype(np.float32)
+
+    def put(self, key: str, scores: np.ndarray) -> None:
+        """Append the scores of ``key`` unless they are already stored."""
+
+        if key in self.rows:
+            return
+        if self.width is None:
+            self.width = len(scores)
+        elif len(scores) != self.width:
+            raise ValueError(f"expected {self.width} scores, got {len(scores)}")
+        row_bytes = _DTYPE.itemsize * self.width
+        self.matrix_path.parent.mkdir(parents=True, exist_ok=True)
+        with self.matrix_path.open("ab") as fh:
+            end = fh.seek(0, os.SEEK_END)
+            if end % row_bytes:  # partial row of an interrupted write
+                end -= end % row_bytes
+                fh.truncate(end)
+            fh.write(np.asarray(scores, dtype=_DTYPE).tobytes())
+        self.rows[key] = end // row_bytes
+
+    def save(self) -> None:
+        """Write the key to row index next to the matrix."""
+
+        if self.width is None:
+            return
+        tmp = self.index_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"width": self.width, "rows": self.rows}, separators=(",", ":")))
+        tmp.replace(self.index_path)